@@ -2,4 +2,8 @@
 # -*- coding: utf-8 -*-
 
 from .app import main
-main()
+
+
+# not run when imported by the worker processes of the importer
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+#
+# refacedx/aiomidi.py
+"""Asyncio client for the Yamaha Reface DX.
+
+``AsyncRefaceDX`` has the same methods as ``midiio.RefaceDX``, but those sending MIDI messages or
+waiting for replies are coroutines. SysEx messages received in the rtmidi callback thread are
+passed to the event loop with ``call_soon_threadsafe``, so no thread blocks while waiting for a
+reply and requests to devices on several ports can run concurrently in one thread, e.g.::
+
+    async def backup(clients):
+        return await asyncio.gather(*(client.patch_request() for client in clients))
+
+Bulk dump replies carry no reference to the request, so the patch requests of one client, i.e.
+one port, are run one after another. The messages sent by one client are also serialized, so the
+messages of a voice dump are never interleaved with others on the same port.
+
+All coroutines can be cancelled, e.g. with ``asyncio.wait_for``. Late replies to a cancelled
+request are discarded when the next request is sent. Other unexpected messages are skipped, since
+only messages with the addresses in ``ADDRESSES_VOICE_BLOCK`` are accepted, each once, and blocks
+with a wrong checksum are requested again (see ``midiio.VoiceDumpCollector``).
+
+"""
+
+import asyncio
+import logging
+import time
+from collections import Counter
+from os.path import join
+
+from rtmidi.midiconstants import PROGRAM_CHANGE, SYSTEM_EXCLUSIVE
+
+from .constants import ADDRESS_HEADER, DUMP_REQUEST
+from .codec import is_voice
+from .midiio import (LatencyEstimator, TimeoutError, VoiceDumpCollector,
+                     get_parameter_changes)
+from .util import iter_sysex
+
+
+__all__ = ('AsyncRefaceDX',)
+
+log = logging.getLogger(__name__)
+
+
+class AsyncRefaceDX:
+    """Asyncio client for a Reface DX connected to a pair of rtmidi ports.
+
+    The client must be created in a coroutine, or the event loop must be passed as ``loop``.
+    Timeouts adapt to the measured latency of the ports, corrupt blocks are counted and voices are
+    sent as parameter changes, if ``send_changes`` is enabled, like in ``midiio.RefaceDX``.
+
+    """
+
+    def __init__(self, midiin=None, midiout=None, device=0, channel=0, timeout=5.0, loop=None,
+                 debug=False, max_retries=2, send_changes=False):
+        self.max_retries = max_retries
+        self.send_changes = send_changes
+        self.loop = loop if loop is not None else asyncio.get_running_loop()
+        self.device = device
+        self.channel = channel
+        self.debug = debug
+        self.timeout = timeout
+        # created in the event loop, see _init_loop_objects
+        self.queue = None
+        self._request_lock = None
+        self._send_lock = None
+        self._midiin = None
+        self.midiin = midiin
+        self.midiout = midiout
+
+    @property
+    def midiin(self):
+        return self._midiin
+
+    @midiin.setter
+    def midiin(self, value):
+        if self._midiin:
+            self._midiin.cancel_callback()
+
+        self._midiin = value
+        self.reset_stats()
+
+        if self._midiin:
+            self._midiin.ignore_types(sysex=False)
+            self._midiin.set_callback(self._msg_callback)
+
+    @property
+    def midiout(self):
+        return self._midiout
+
+    @midiout.setter
+    def midiout(self, value):
+        self._midiout = value
+        self.edit_buffer = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Forget the latencies measured and corrupt blocks counted, e.g. when the ports change."""
+        self.first_latency = LatencyEstimator(self.timeout)
+        self.block_latency = LatencyEstimator(self.timeout)
+        self.received_blocks = 0
+        self.corrupt_blocks = Counter()
+
+    def _init_loop_objects(self):
+        # before Python 3.10, asyncio queues and locks are bound to the current event loop when
+        # created, so they are created when first used in the event loop of the client
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+            self._request_lock = asyncio.Lock()
+            self._send_lock = asyncio.Lock()
+
+    def _put(self, item):
+        # called in the event loop
+        self._init_loop_objects()
+        self.queue.put_nowait(item)
+
+    def close(self):
+        """Stop receiving messages from the MIDI input. The ports are not closed."""
+        self.midiin = None
+
+    def _msg_callback(self, event, data):
+        # called in the rtmidi callback thread
+        msg, delta = event
+
+        if msg[0] == SYSTEM_EXCLUSIVE:
+            if self.debug:
+                log.debug("MIDI RECV: %r", bytes(msg))
+
+            try:
+                self.loop.call_soon_threadsafe(self._put, (msg, time.perf_counter()))
+            except RuntimeError:
+                # event loop is closed
+                pass
+
+    def _send(self, msg):
+        if self.debug:
+            log.debug("MIDI SEND: %r", bytes(msg))
+        if self.midiout:
+            self.midiout.send_message(msg)
+
+    async def dump_request(self, address=ADDRESS_HEADER, device=None):
+        if device is None:
+            device = self.device
+        msg = bytearray(DUMP_REQUEST)
+        msg[2] |= device
+        msg[6] = address[0]
+        msg[7] = address[1]
+        msg[8] = address[2]
+        self._init_loop_objects()
+
+        async with self._send_lock:
+            self._send(msg)
+
+    async def patch_request(self, device=None, timeout=None):
+        """Request the voice in the edit buffer of the device and return its bulk dump data.
+
+        Raises ``midiio.TimeoutError`` if any of the voice dump messages is not received within
+        the adaptive timeout or, if given, ``timeout`` seconds, or ``midiio.ChecksumError`` if a
+        block is still corrupt after requesting it again.
+
+        """
+        self._init_loop_objects()
+
+        async with self._request_lock:
+            # discard late replies to earlier requests
+            while not self.queue.empty():
+                self.queue.get_nowait()
+
+            await self.dump_request(device=device, address=ADDRESS_HEADER)
+            collector = VoiceDumpCollector(self.max_retries)
+            estimator = self.first_latency
+            retrying = False
+            last = time.perf_counter()
+
+            try:
+                while not collector.complete:
+                    wait = estimator.timeout if timeout is None else timeout
+
+                    try:
+                        part, received = await asyncio.wait_for(self.queue.get(), wait)
+                    except asyncio.TimeoutError:
+                        if timeout is None:
+                            estimator.backoff()
+
+                        raise TimeoutError("No valid patch received within timeout (%.3f sec.)" %
+                                           wait) from None
+
+                    # replies to a block requested again may interleave with the remaining blocks
+                    if not retrying:
+                        estimator.add(received - last)
+
+                    last = received
+                    address = collector.add(part)
+
+                    if address is not None:
+                        await self.dump_request(address=address, device=device)
+                        retrying = True
+                        estimator = self.first_latency
+                    elif not retrying:
+                        estimator = self.block_latency
+            finally:
+                self.received_blocks += collector.received
+                self.corrupt_blocks.update(collector.corrupt)
+
+            patch = collector.get_patch()
+            self.edit_buffer = bytes(patch)
+            return patch
+
+    async def send_patch(self, data, interval=0.0):
+        """Send all SysEx messages in given data or binary file object.
+
+        Control is returned to the event loop after each message, waiting ``interval`` seconds,
+        so other tasks run while large files are sent. If ``send_changes`` is enabled and data is
+        a single voice, only the parameters differing from ``edit_buffer`` are sent, unless a bulk
+        dump of the voice is shorter.
+
+        """
+        voice = isinstance(data, (bytes, bytearray)) and is_voice(data)
+        changes = None
+
+        self._init_loop_objects()
+
+        async with self._send_lock:
+            if self.send_changes and voice:
+                changes = get_parameter_changes(self.edit_buffer, data, self.device)
+
+            if changes is not None:
+                log.debug("Sending %i parameter change(s) instead of bulk dump.", len(changes))
+
+            for msg in iter_sysex(data) if changes is None else changes:
+                self._send(msg)
+                await asyncio.sleep(interval)
+
+            self.edit_buffer = bytes(data) if voice else None
+
+    async def send_patchfile(self, *names, interval=0.0):
+        path = join(*names)
+        with open(path, 'rb') as syx:
+            await self.send_patch(syx, interval)
+
+    async def send_program_change(self, program, channel=None):
+        if channel is None:
+            channel = self.channel
+        self._init_loop_objects()
+        async with self._send_lock:
+            self._send([PROGRAM_CHANGE | (channel & 0xF), program & 0x7F])
+            # the device loads the voice of the program into its edit buffer
+            self.edit_buffer = None
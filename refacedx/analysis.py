@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+#
+# refacedx/analysis.py
+"""Vectorized access to the voice parameters of all patches in the library with NumPy.
+
+``load_voice_array`` returns a NumPy structured array with one record per patch and a field per
+voice parameter (see ``codec.PARAMS``) plus the ``patch_id``. Since every voice has the same
+fixed layout, the voice data of all patches is concatenated into one buffer and viewed as a 2D
+byte array, from which the headers are validated and the parameter bytes gathered with array
+indexing, so no per-voice Python code runs.
+
+The array is cached in a ``.npy`` file next to the database, whose name contains the schema
+version and the patch data version of the database, so it is only rebuilt after patches have
+been added, changed or deleted. The name also contains digests of the absolute database path and
+of the ids and voice hashes of all patches, so libraries sharing a cache directory, or a database
+restored from a backup, never load the cache of another library.
+
+This module needs NumPy, which is an optional dependency, e.g. install it with
+``pip install reface-dx-lib[analysis]``.
+
+"""
+
+import glob
+import hashlib
+import logging
+import os
+from os.path import basename, dirname, exists, join
+
+import numpy as np
+from sqlalchemy import select
+
+from .codec import (BLOCK_DATA_LENGTHS, DATA_OFFSET, MESSAGE_OFFSETS, PARAMS, VOICE_LENGTH,
+                    Voice, encode)
+from .migrations import get_schema_version
+from .model import Patch, get_data_version
+
+
+__all__ = ('VOICE_DTYPE', 'decode_voices', 'get_cache_path', 'load_voice_array')
+
+log = logging.getLogger(__name__)
+# compact record of the parameters of one patch
+VOICE_DTYPE = np.dtype([('patch_id', '<i8')] +
+                       [(name, '?' if type_ is bool else 'u1')
+                        for name, _, _, type_, _ in PARAMS])
+# offsets of the parameter values in the voice data
+PARAM_OFFSETS = np.array([MESSAGE_OFFSETS[part] + DATA_OFFSET + offset
+                          for _, part, offset, _, _ in PARAMS])
+BOOL_PARAMS = np.array([i for i, param in enumerate(PARAMS) if param[3] is bool])
+# all parameter fields are single bytes following the patch id
+PARAMS_START = VOICE_DTYPE.fields[PARAMS[0][0]][1]
+
+
+def _get_header_checks():
+    """Return positions and values of fixed bytes and positions of device number bytes."""
+    reference = np.frombuffer(encode(Voice('', *([0] * len(PARAMS)))), dtype=np.uint8)
+    fixed = []
+    device = []
+
+    for start, length in zip(MESSAGE_OFFSETS, BLOCK_DATA_LENGTHS):
+        device.append(start + 2)
+        fixed.extend(range(start, start + 2))
+        fixed.extend(range(start + 3, start + DATA_OFFSET))
+        fixed.append(start + DATA_OFFSET + length + 1)
+
+    return np.array(fixed), reference[fixed], np.array(device)
+
+
+FIXED_POSITIONS, FIXED_VALUES, DEVICE_POSITIONS = _get_header_checks()
+
+
+def decode_voices(blobs, ids=None):
+    """Decode sequence of voice data blobs into a structured array with ``VOICE_DTYPE``.
+
+    Blobs which are not a single Reface DX voice bulk dump are skipped. If ``ids`` is given, it
+    must be a sequence of the same length as ``blobs`` and is used for the ``patch_id`` field,
+    otherwise the field holds the index of each blob.
+
+    """
+    if ids is None:
+        ids = range(len(blobs))
+
+    valid_ids = np.fromiter((id_ for id_, data in zip(ids, blobs) if len(data) == VOICE_LENGTH),
+                            dtype='<i8')
+    buf = b''.join(data for data in blobs if len(data) == VOICE_LENGTH)
+    raw = np.frombuffer(buf, dtype=np.uint8).reshape(-1, VOICE_LENGTH)
+    valid = ((raw[:, FIXED_POSITIONS] == FIXED_VALUES).all(axis=1) &
+             (raw[:, DEVICE_POSITIONS] < 0x10).all(axis=1))
+
+    rows = np.flatnonzero(valid)
+    values = raw[np.ix_(rows, PARAM_OFFSETS)]
+    # NumPy booleans must be 0 or 1
+    values[:, BOOL_PARAMS] = values[:, BOOL_PARAMS] != 0
+
+    result = np.empty(len(rows), dtype=VOICE_DTYPE)
+    result['patch_id'] = valid_ids[rows]
+    result.view(np.uint8).reshape(len(rows), VOICE_DTYPE.itemsize)[:, PARAMS_START:] = values
+
+    skipped = len(blobs) - len(result)
+
+    if skipped:
+        log.debug("Skipped %i blob(s) not containing a valid voice.", skipped)
+
+    return result
+
+
+def _get_patches_digest(session):
+    """Return hex digest of the ids and voice hashes of all patches."""
+    table = Patch.__table__
+    digest = hashlib.sha1()
+
+    for id_, hash_ in session.execute(select([table.c.id, table.c.hash]).order_by(table.c.id)):
+        digest.update(b'%i:%s\n' % (id_, (hash_ or '').encode('ascii')))
+
+    return digest.hexdigest()
+
+
+def get_cache_path(session, cache_dir=None):
+    """Return path of voice array cache file for the current version of the database.
+
+    Returns None for databases not stored in a file.
+
+    """
+    database = session.get_bind().url.database
+
+    if not database or database == ':memory:':
+        return None
+
+    database = os.path.abspath(database)
+    conn = session.connection()
+    path_digest = hashlib.sha1(database.encode('utf-8')).hexdigest()
+    return join(cache_dir or dirname(database), '%s-%s.voices-%i-%i-%s.npy' % (
+        basename(database), path_digest[:12], get_schema_version(conn), get_data_version(session),
+        _get_patches_digest(session)[:12]))
+
+
+def load_voice_array(session, cache_dir=None, use_cache=True):
+    """Return structured array with the voice parameters of all patches, ordered by patch id.
+
+    The voice data of all patches is fetched with a single query and decoded with
+    ``decode_voices``. If ``use_cache`` is True, the array is loaded from or saved to a cache file
+    (see ``get_cache_path``) in ``cache_dir``, which defaults to the database directory.
+
+    """
+    with session.begin():
+        path = get_cache_path(session, cache_dir) if use_cache else None
+
+        if path and exists(path):
+            try:
+                voices = np.load(path)
+            except (OSError, ValueError) as exc:
+                log.warning("Could not load voice array cache '%s': %s", path, exc)
+            else:
+                if voices.dtype == VOICE_DTYPE:
+                    log.debug("Loaded %i voice(s) from cache '%s'.", len(voices), path)
+                    return voices
+
+        table = Patch.__table__
+        rows = session.execute(select([table.c.id, table.c.data]).order_by(table.c.id)).fetchall()
+
+    voices = decode_voices([row[1] for row in rows], [row[0] for row in rows])
+    log.debug("Decoded %i voice(s) from database.", len(voices))
+
+    if path:
+        _save_cache(voices, path)
+
+    return voices
+
+
+def _save_cache(voices, path):
+    tmp_path = path + '.tmp'
+
+    try:
+        with open(tmp_path, 'wb') as fp:
+            np.save(fp, voices)
+
+        os.replace(tmp_path, path)
+    except OSError as exc:
+        log.warning("Could not write voice array cache '%s': %s", path, exc)
+        return
+
+    # remove caches of older versions of the database
+    prefix = path.rsplit('.voices-', 1)[0]
+
+    for stale in glob.glob(glob.escape(prefix) + '.voices-*.npy'):
+        if stale != path:
+            try:
+                os.remove(stale)
+            except OSError:
+                pass
@@ -4,32 +4,47 @@
 # refacedx/app.py
 
 import logging
+import os
 import sys
 from datetime import datetime
 from functools import partial
-from os.path import basename, dirname, exists, join, splitext
+from os.path import abspath, basename, dirname, exists, isdir, join
 
 try:
-    from qtpy.QtCore import QSettings, Qt, QThread, QTimer, Slot
+    from qtpy.QtCore import QFileSystemWatcher, QSettings, Qt, QThread, QTimer, Slot
     from qtpy.QtGui import QIcon
     from qtpy.QtWidgets import (QApplication, QComboBox, QCompleter, QDialog, QFileDialog,
-                                QMainWindow, QMessageBox)
+                                QMainWindow, QMessageBox, QProgressBar)
 except ImportError:
-    from PyQt5.QtCore import QSettings, QThread, QTimer, Qt, pyqtSlot as Slot
+    from PyQt5.QtCore import (QFileSystemWatcher, QSettings, QThread, QTimer, Qt,
+                              pyqtSlot as Slot)
     from PyQt5.QtGui import QIcon
     from PyQt5.QtWidgets import (QApplication, QComboBox, QCompleter, QDialog,
-                                 QFileDialog, QMainWindow, QMessageBox)
+                                 QFileDialog, QMainWindow, QMessageBox, QProgressBar)
 
 from . import icons_rcc
 from .adddialog_ui import Ui_AddPatchDialog
+from .archive import ARCHIVE_FORMATS, is_archive
+from .codec import decode, encode, voice_hash
+from .filethread import FileWorker
 from .midithread import MidiWorker
-from .model import Author, Device, Manufacturer, Patch, get_or_create, initdb
+from .model import (SQLITE_PRAGMAS, Author, Device, Manufacturer, Patch, get_or_create, initdb,
+                    load_patch_data)
 from .refacedxlib_ui import Ui_MainWindow
 from .style import DarkAppStyle
-from .util import get_fullname, get_patch_name, is_reface_dx_voice, set_patch_name
+from .util import get_fullname
 from .viewmodel import AuthorListModel, DeviceListModel, ManufacturerListModel, PatchlistTableModel
 
+try:
+    from .similarity import find_similar
+except ImportError:
+    # NumPy is not installed
+    find_similar = None
+
 log = logging.getLogger('refacedx')
+ARCHIVE_FILE_FILTER = "Archives ({})".format(' '.join('*' + ext for ext in ARCHIVE_FORMATS))
+IMPORT_FILE_FILTER = "SysEx Files and Archives (*.syx {});;All Files (*)".format(
+    ' '.join('*' + ext for ext in ARCHIVE_FORMATS))
 
 
 class AddPatchDialog(QDialog, Ui_AddPatchDialog):
@@ -71,7 +86,7 @@ class AddPatchDialog(QDialog, Ui_AddPatchDialog):
         if self._last_author is None:
             self._last_author = get_fullname()
 
-        name = get_patch_name(data)
+        name = decode(data).name
         self.name_entry.setText(name)
         self.shortname_entry.setText(name)
         self.created_dt.setDateTime(datetime.now())
@@ -110,6 +125,14 @@ class RefaceDXLibMainWin(QMainWindow, Ui_MainWindow):
         self.setupUi(self)
         self.midi_setup.hide()
         self.action_midi.triggered.connect(self.toggle_midi_options)
+        self.progressbar = QProgressBar()
+        self.progressbar.setMaximumWidth(200)
+        self.progressbar.hide()
+        self.statusbar.addPermanentWidget(self.progressbar)
+        # context menu of patch list
+        for action in (self.action_send, self.action_similar, self.action_export,
+                       self.action_export_archive, self.action_delete):
+            self.table_patches.addAction(action)
         # Set the size and title
         self.setMinimumSize(800, 600)
         self.setWindowTitle(title)
@@ -118,6 +141,11 @@ class RefaceDXLibMainWin(QMainWindow, Ui_MainWindow):
     def toggle_midi_options(self):
         self.midi_setup.setVisible(not self.midi_setup.isVisible())
 
+    @property
+    def readonly(self):
+        """True if the patch library database was opened read-only."""
+        return getattr(self, '_model', None) is not None and self._model.readonly
+
     def set_patchtable_model(self, value):
         self._model = value
         self.table_patches.setModel(self._model)
@@ -125,8 +153,10 @@ class RefaceDXLibMainWin(QMainWindow, Ui_MainWindow):
         self.selection = self.table_patches.selectionModel()
         self.selection.selectionChanged.connect(self.set_send_action_enabled)
         self.selection.selectionChanged.connect(self.set_export_action_enabled)
+        self.selection.selectionChanged.connect(self.set_similar_action_enabled)
         self.set_export_action_enabled()
         self.set_send_action_enabled()
+        self.set_similar_action_enabled()
         self.table_patches.horizontalHeader().setSectionsMovable(True)
         self.table_patches.verticalHeader().setSectionsMovable(True)
 
@@ -134,13 +164,27 @@ class RefaceDXLibMainWin(QMainWindow, Ui_MainWindow):
     @Slot(bool)
     def set_export_action_enabled(self, enable=None):
         if enable is None:
-            enable = self.selection.hasSelection()
+            enable = self.selection.hasSelection() and not self.action_cancel.isEnabled()
         self.action_export.setEnabled(bool(enable))
+        self.action_export_archive.setEnabled(bool(enable))
+
+    @Slot(bool)
+    def set_file_job_active(self, active):
+        self.action_import.setEnabled(not active and not self.readonly)
+        self.action_cancel.setEnabled(active)
+        self.progressbar.setVisible(active)
+
+        if active:
+            self.progressbar.setValue(0)
+            self.set_export_action_enabled(False)
+        else:
+            self.set_export_action_enabled()
 
     @Slot()
     @Slot(bool)
     def set_request_action_enabled(self, enable=True):
-        self.action_request.setEnabled(enable)
+        # received patches are saved to the library
+        self.action_request.setEnabled(bool(enable) and not self.readonly)
 
     @Slot()
     @Slot(bool)
@@ -149,6 +193,14 @@ class RefaceDXLibMainWin(QMainWindow, Ui_MainWindow):
             enable = self.selection.hasSelection()
         self.action_send.setEnabled(bool(enable))
 
+    @Slot()
+    @Slot(bool)
+    def set_similar_action_enabled(self, enable=None):
+        if enable is None:
+            enable = (self._model.similarity_search is not None and
+                      len(self.selection.selectedRows()) == 1)
+        self.action_similar.setEnabled(bool(enable))
+
 
 class RefaceDXLibApp(QApplication):
     """The main application object with the central event handling."""
@@ -172,11 +224,14 @@ class RefaceDXLibApp(QApplication):
                             format='%(levelname)s - %(message)s')
 
         self.mainwin = RefaceDXLibMainWin(self.tr(self.name))
+        self.setup_folder_watcher()
         self.load_database(self.config.value('database/last_opened', 'refacedx.db'))
 
         self.midiin_conn = None
         self.midiout_conn = None
         self.setup_midi_thread()
+        self.file_errors = []
+        self.setup_file_thread()
 
         # signal connections
         self.aboutToQuit.connect(self.quit)
@@ -184,9 +239,24 @@ class RefaceDXLibApp(QApplication):
         self.mainwin.action_quit.triggered.connect(self.quit)
         self.mainwin.action_import.triggered.connect(self.import_patches)
         self.mainwin.action_export.triggered.connect(self.export_patches)
+        self.mainwin.action_export_archive.triggered.connect(self.export_archive)
+        # run in the GUI thread, a queued call would wait for the running job to finish
+        self.mainwin.action_cancel.triggered.connect(self.fileworker.cancel,
+                                                     type=Qt.DirectConnection)
+        self.mainwin.action_watch.triggered.connect(self.watch_folder)
+        self.mainwin.action_unwatch.triggered.connect(self.unwatch_folders)
+        self.mainwin.action_sync.triggered.connect(self.sync_folders)
         self.mainwin.action_send.triggered.connect(self.send_patches)
         self.mainwin.action_request.triggered.connect(self.request_patch)
         self.mainwin.action_delete.triggered.connect(self.delete_patches)
+        self.mainwin.action_similar.triggered.connect(self.find_similar_patches)
+
+        # search as you type, but only when typing pauses
+        self.search_timer = QTimer()
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(200)
+        self.search_timer.timeout.connect(self.search_patches)
+        self.mainwin.search_entry.textChanged.connect(self.search_timer.start)
 
         # dialogs (initialized on-demand)
         self.add_patch_dialog = None
@@ -195,10 +265,29 @@ class RefaceDXLibApp(QApplication):
         self.mainwin.show()
 
     def load_database(self, filename):
+        self.mainwin.search_entry.clear()
         db_uri = 'sqlite:///{}'.format(filename)
-        self.session = initdb(db_uri, debug=self.config.value('database/debug', False))
+        pragmas = {name: self.config.value('database/' + name) for name in SQLITE_PRAGMAS
+                   if self.config.contains('database/' + name)}
+        readonly = self.config.value('database/readonly', False, type=bool)
+        self.session = initdb(db_uri, debug=self.config.value('database/debug', False),
+                              pragmas=pragmas, readonly=readonly)
         self.patches = PatchlistTableModel(self.session)
+        self.patches.readonly = readonly
+
+        if find_similar is not None:
+            self.patches.similarity_search = partial(
+                find_similar, self.session,
+                count=self.config.value('similarity/count', 20, type=int))
+
         self.mainwin.set_patchtable_model(self.patches)
+        self.mainwin.action_import.setEnabled(not readonly)
+        self.mainwin.action_delete.setEnabled(not readonly)
+        self.mainwin.action_watch.setEnabled(not readonly)
+        self.mainwin.set_request_action_enabled(True)
+        self.update_watched_folders()
+        # import files added to the watched folders while the application was not running
+        self.schedule_sync()
 
     def setup_midi_thread(self):
         self.midithread = QThread()
@@ -224,6 +313,58 @@ class RefaceDXLibApp(QApplication):
         self.timer.timeout.connect(self.midiworker.scan_ports.emit)
         self.timer.start(3000)
 
+    def setup_file_thread(self):
+        self.filethread = QThread()
+        self.fileworker = FileWorker(self.config)
+        self.fileworker.moveToThread(self.filethread)
+
+        self.fileworker.job_start.connect(self.file_job_started)
+        self.fileworker.progress.connect(self.file_job_progress)
+        self.fileworker.file_error.connect(self.file_job_error)
+        self.fileworker.batch_committed.connect(self.refresh_patches)
+        self.fileworker.import_complete.connect(self.import_complete)
+        self.fileworker.sync_complete.connect(self.sync_complete)
+        self.fileworker.export_complete.connect(self.export_complete)
+
+        # Start thread
+        self.filethread.start()
+
+    def setup_folder_watcher(self):
+        # sync only when changes pause, since files are often copied into a folder one by one
+        self.sync_timer = QTimer()
+        self.sync_timer.setSingleShot(True)
+        self.sync_timer.setInterval(self.config.value('sync/delay', 2000, type=int))
+        self.sync_timer.timeout.connect(self.sync_folders)
+        self.watcher = QFileSystemWatcher()
+        self.watcher.directoryChanged.connect(self.schedule_sync)
+
+    def get_watched_folders(self):
+        return self.config.value('sync/folders', [], type=list)
+
+    def update_watched_folders(self):
+        """Watch the configured folders and, if syncing recursively, all their sub-folders."""
+        folders = [] if self.patches.readonly else self.get_watched_folders()
+        recursive = self.config.value('sync/recursive', True, type=bool)
+        dirs = set()
+
+        for folder in filter(isdir, folders):
+            dirs.add(abspath(folder))
+
+            if recursive:
+                for root, subdirs, _ in os.walk(abspath(folder)):
+                    dirs.update(join(root, subdir) for subdir in subdirs)
+
+        watched = set(self.watcher.directories())
+
+        if watched - dirs:
+            self.watcher.removePaths(list(watched - dirs))
+
+        if dirs - watched:
+            self.watcher.addPaths(sorted(dirs - watched))
+
+        self.mainwin.action_unwatch.setEnabled(bool(folders))
+        self.mainwin.action_sync.setEnabled(bool(folders))
+
     @Slot(object)
     def build_midi_input_selector(self, ports):
         log.debug("Building MIDI input selector...")
@@ -287,6 +428,9 @@ class RefaceDXLibApp(QApplication):
         self.midiworker.close.emit()
         self.midithread.quit()
         self.midithread.wait()
+        self.fileworker.cancel()
+        self.filethread.quit()
+        self.filethread.wait()
         self.mainwin.close()
 
     def open_database(self):
@@ -315,10 +459,15 @@ class RefaceDXLibApp(QApplication):
                 self.config.setValue('database/last_opened', filename)
 
     def save_patch(self, data, **meta):
-        name = meta.get('name', '').strip()
+        voice = decode(data)
+        name = meta.get('name', '').strip() or voice.name
+        data = encode(voice._replace(name=name), template=data)
+        duplicate = (self.session.query(Patch.displayname)
+                     .filter_by(hash=voice_hash(data)).one_or_none())
 
-        if not name:
-            name = get_patch_name(data)
+        if duplicate:
+            log.info("Patch '%s' is already in the library as '%s'.", name, duplicate[0])
+            return False
 
         with self.session.begin():
             author = meta.get('author', '').strip()
@@ -360,17 +509,52 @@ class RefaceDXLibApp(QApplication):
                 manufacturer=manufacturer,
                 device=device,
                 created=meta.get('created', datetime.now()),
-                data=set_patch_name(data, name))
+                data=data)
             self.session.add(patch)
 
             tags = (tag.strip() for tag in meta.get('tags', '').split(','))
             patch.update_tags(self.session, (tag for tag in tags if tag))
 
+        return True
+
+    def search_patches(self):
+        try:
+            ranked = self.patches.search(self.mainwin.search_entry.text())
+        except ValueError as exc:
+            self.set_status_text(str(exc))
+            return
+
+        if ranked:
+            # results are ordered by relevance
+            self.mainwin.table_patches.horizontalHeader().setSortIndicator(-1, Qt.AscendingOrder)
+
+    def find_similar_patches(self):
+        rows = self.mainwin.selection.selectedRows()
+
+        if len(rows) == 1:
+            patch = self.patches.get_row(rows[0])
+            # show results via search filter, so clearing the search shows all patches again
+            self.mainwin.search_entry.setText('similar:{}'.format(patch.id))
+            self.search_timer.stop()
+            self.search_patches()
+
     def request_patch(self):
         self.midiworker.request_patch.emit(None)
 
     def receive_patch(self, data):
-        log.debug("Patch received: %s", get_patch_name(data))
+        try:
+            log.debug("Patch received: %s", decode(data).name)
+        except ValueError as exc:
+            log.error("Invalid patch data received: %s", exc)
+            self.set_status_text(self.tr("Received data is not a valid Reface DX voice."))
+            self.mainwin.set_request_action_enabled(True)
+            return
+
+        if self.patches.readonly:
+            log.warning("Not saving received patch, the database is read-only.")
+            self.set_status_text(self.tr("Database is read-only, received patch not saved."))
+            self.mainwin.set_request_action_enabled(True)
+            return
 
         if self.add_patch_dialog is None:
             self.add_patch_dialog = AddPatchDialog(self)
@@ -379,9 +563,10 @@ class RefaceDXLibApp(QApplication):
 
         if metadata:
             log.debug("Patch meta data: %r", metadata)
-            self.save_patch(data, **metadata)
-            self.patches._update()
-            self.patches.layoutChanged.emit()
+            if self.save_patch(data, **metadata):
+                self.refresh_patches()
+            else:
+                self.set_status_text(self.tr("Patch is already in the library."))
 
         self.mainwin.set_request_action_enabled(True)
 
@@ -416,28 +601,54 @@ class RefaceDXLibApp(QApplication):
 
         files, _ = QFileDialog.getOpenFileNames(self.mainwin, self.tr("Import SysEx patches"),
                                                 self.config.value('paths/last_import_path', ''),
-                                                "SysEx Files (*.syx);;All Files (*)",
+                                                IMPORT_FILE_FILTER,
                                                 options=options)
 
         if files:
             self.config.setValue('paths/last_import_path', dirname(files[0]))
 
-            self.patches.layoutAboutToBeChanged.emit()
-            with self.session.begin():
-                for file in files:
-                    with open(file, 'rb') as syx:
-                        data = syx.read()
+            self.fileworker.import_files.emit(files)
+
+    def watch_folder(self):
+        options = QFileDialog.Options()
+
+        if not self.config.value('native_dialogs', False):
+            options |= QFileDialog.DontUseNativeDialog | QFileDialog.ShowDirsOnly
+
+        dir_ = QFileDialog.getExistingDirectory(
+            self.mainwin,
+            self.tr("Choose folder to import SysEx patches from automatically"),
+            self.config.value('paths/last_import_path', ''),
+            options=options)
+
+        if dir_:
+            folders = self.get_watched_folders()
+
+            if abspath(dir_) not in folders:
+                folders.append(abspath(dir_))
+                self.config.setValue('sync/folders', folders)
+
+            self.update_watched_folders()
+            self.sync_folders()
+
+    def unwatch_folders(self):
+        self.config.remove('sync/folders')
+        self.update_watched_folders()
+        self.set_status_text(self.tr("Stopped watching folders."))
+
+    @Slot()
+    @Slot(str)
+    def schedule_sync(self, path=None):
+        if not self.patches.readonly and self.get_watched_folders():
+            self.sync_timer.start()
 
-                    #assert len(data) == 241
-                    if is_reface_dx_voice(data):
-                        name = get_patch_name(data)
-                        displayname = splitext(basename(file))[0].replace('_', ' ').strip()
-                        patch = Patch(name=name, displayname=displayname, data=data)
-                        self.session.add(patch)
+    @Slot()
+    def sync_folders(self):
+        folders = self.get_watched_folders()
 
-            # TODO: check if any patches were actually added
-            self.patches._update()
-            self.patches.layoutChanged.emit()
+        if folders and not self.patches.readonly:
+            self.fileworker.sync_folders.emit(
+                folders, self.config.value('sync/recursive', True, type=bool))
 
     def export_patches(self):
         if self.mainwin.selection.hasSelection():
@@ -455,50 +666,107 @@ class RefaceDXLibApp(QApplication):
 
             if dir_:
                 self.config.setValue('paths/last_export_path', dir_)
+                ids = [self.patches.get_row(row).id
+                       for row in self.mainwin.selection.selectedRows()]
+                self.fileworker.export_patches.emit(ids, dir_)
+            else:
+                self.set_status_text(self.tr("Patch export cancelled."))
+
+    def export_archive(self):
+        if self.mainwin.selection.hasSelection():
+            options = QFileDialog.Options()
+
+            if not self.config.value('native_dialogs', False):
+                options |= QFileDialog.DontUseNativeDialog
 
-                ignore_all = False
-                exported = 0
-                for row in self.mainwin.selection.selectedRows():
-                    patch = self.patches.get_row(row)
-
-                    try:
-                        filename = patch.displayname.replace(' ', '_') + '.syx'
-                        with open(join(dir_, filename), 'wb') as syx:
-                            syx.write(patch.data)
-                    except OSError as exc:
-                        log.error("Could not write SysEx file at '%s': %s", filename, exc)
-
-                        if ignore_all:
-                            continue
-
-                        dlg = self.create_error_dlg(self.tr("Could not write SysEx file "
-                            "<i>{}</i>.").format(basename(filename)),
-                            info=self.tr("Abort export, ignore error or ignore all errors?"),
-                            detail=str(exc))
-                        ret = dlg.exec_()
-
-                        if dlg.clickedButton() == dlg.btn_ignoreall:
-                            ignore_all = True
-                        elif ret == QMessageBox.Abort:
-                            log.warning("Patch export aborted.")
-                            break
-                        elif ret == QMessageBox.Ignore:
-                            pass
-                        else:
-                            log.error("Unknown error dialog response. This shouldn't happen.")
-                    else:
-                        exported += 1
-
-                self.set_status_text(self.tr("{} patches exported.").format(exported))
+            filename, _ = QFileDialog.getSaveFileName(
+                self.mainwin,
+                self.tr("Export SysEx patches to archive"),
+                self.config.value('paths/last_export_path', ''),
+                ARCHIVE_FILE_FILTER,
+                options=options)
+
+            if filename:
+                if not is_archive(filename):
+                    filename += '.zip'
+
+                self.config.setValue('paths/last_export_path', dirname(filename))
+                ids = [self.patches.get_row(row).id
+                       for row in self.mainwin.selection.selectedRows()]
+                self.fileworker.export_archive.emit(ids, filename)
             else:
                 self.set_status_text(self.tr("Patch export cancelled."))
 
+    @Slot()
+    @Slot(int)
+    def refresh_patches(self, count=None):
+        self.patches.refresh()
+
+    @Slot(int)
+    def file_job_started(self, total):
+        self.file_errors = []
+        self.mainwin.set_file_job_active(True)
+        self.mainwin.progressbar.setMaximum(total)
+
+    @Slot(int, int)
+    def file_job_progress(self, done, total):
+        self.mainwin.progressbar.setValue(done)
+
+    @Slot(str, str)
+    def file_job_error(self, filename, message):
+        self.file_errors.append("{}: {}".format(basename(filename), message))
+
+    @Slot(object)
+    def import_complete(self, stats):
+        self.mainwin.set_file_job_active(False)
+
+        if stats.imported:
+            self.refresh_patches()
+            self.set_status_text(self.tr("{} patches imported.").format(stats.imported))
+        else:
+            self.set_status_text(self.tr("No new patches found."))
+
+        self.show_file_errors(self.tr("{} file(s) could not be imported."))
+
+    @Slot(object)
+    def sync_complete(self, stats):
+        self.mainwin.set_file_job_active(False)
+        # watch sub-folders created since the last sync
+        self.update_watched_folders()
+
+        if stats.imported:
+            self.refresh_patches()
+            self.set_status_text(
+                self.tr("{} patches imported from watched folders.").format(stats.imported))
+        elif self.file_errors:
+            # don't interrupt the user with a dialog for a sync in the background
+            self.set_status_text(
+                self.tr("{} file(s) in watched folders could not be imported.").format(
+                    len(self.file_errors)))
+
+        self.file_errors = []
+
+    @Slot(int)
+    def export_complete(self, exported):
+        self.mainwin.set_file_job_active(False)
+        self.set_status_text(self.tr("{} patches exported.").format(exported))
+        self.show_file_errors(self.tr("{} SysEx file(s) could not be written."))
+
+    def show_file_errors(self, message):
+        if self.file_errors:
+            dlg = self.create_error_dlg(message.format(len(self.file_errors)),
+                                        detail='\n'.join(self.file_errors), ignore_buttons=False)
+            self.file_errors = []
+            dlg.exec_()
+
     def send_patches(self):
         if self.mainwin.selection.hasSelection():
-            for row in self.mainwin.selection.selectedRows():
-                patch = self.patches.get_row(row)
-                self.midiworker.send_patch.emit(patch.data)
-                log.debug("Sent patch: %s (%s)", patch.displayname, patch.name)
+            patches = {patch.id: patch for patch in
+                       map(self.patches.get_row, self.mainwin.selection.selectedRows())}
+
+            for id_, data in load_patch_data(self.session, patches):
+                self.midiworker.send_patch.emit(data)
+                log.debug("Sent patch: %s (%s)", patches[id_].displayname, patches[id_].name)
 
     def create_error_dlg(self, message, info=None, detail=None, ignore_buttons=True):
         dlg = QMessageBox()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+#
+# refacedx/archive.py
+"""Export patches from the library to zip and tar archives.
+
+An exported archive contains one SysEx file per patch, named after the patch display name, and a
+``manifest.json`` file listing the meta data of the patches and the name of the file of each.
+
+Reading and writing archives is implemented in ``archiveio``, which does not depend on the
+database model. Its functions are also available from this module.
+
+"""
+
+import datetime
+import json
+import logging
+
+from sqlalchemy import select
+
+from .archiveio import (ARCHIVE_FORMATS, ArchiveError, ArchiveWriter, get_archive_format,
+                        is_archive, iter_archive, write_archive)
+from .model import MAX_IN_PARAMS, Tag, load_patch_data, patch_tag
+
+
+__all__ = ('ARCHIVE_FORMATS', 'ArchiveError', 'ArchiveWriter', 'export_archive',
+           'get_archive_format', 'is_archive', 'iter_archive', 'write_archive')
+
+log = logging.getLogger(__name__)
+MANIFEST_NAME = 'manifest.json'
+
+
+def _get_member_name(displayname, used):
+    """Return unique SysEx file name for patch with given display name."""
+    stem = displayname.replace(' ', '_').replace('/', '_').replace('\\', '_') or 'patch'
+    name = stem + '.syx'
+    num = 1
+
+    while name.lower() in used:
+        num += 1
+        name = '%s_%i.syx' % (stem, num)
+
+    used.add(name.lower())
+    return name
+
+
+def _get_patch_tags(session, ids):
+    """Return dict mapping given patch ids to lists of their tag names."""
+    tag = Tag.__table__
+    tags = {}
+
+    for i in range(0, len(ids), MAX_IN_PARAMS):
+        query = select([patch_tag.c.patch_id, tag.c.name]).select_from(
+            patch_tag.join(tag)).where(patch_tag.c.patch_id.in_(ids[i:i + MAX_IN_PARAMS]))
+
+        for patch_id, name in session.execute(query.order_by(tag.c.name)):
+            tags.setdefault(patch_id, []).append(name)
+
+    return tags
+
+
+def export_archive(session, ids, filename, progress=None, cancel=None):
+    """Write the patches with given ids to a zip or tar archive with given file name.
+
+    The archive format is determined by the file name extension (see ``ARCHIVE_FORMATS``). The
+    whole archive is written through a single open file. If ``progress`` is given, it is called
+    with the number of patches written so far and the total number after each chunk of patches.
+
+    ``cancel`` may be a ``threading.Event``. When it is set, no further patches are written, but
+    the archive is completed with a manifest of the patches written so far.
+
+    Returns the number of patches written.
+
+    """
+    ids = list(ids)
+    total = len(ids)
+    used = {MANIFEST_NAME}
+    manifest = []
+
+    with ArchiveWriter(filename) as writer:
+        for i in range(0, total, MAX_IN_PARAMS):
+            if cancel is not None and cancel.is_set():
+                log.warning("Patch export cancelled.")
+                break
+
+            chunk = load_patch_data(session, ids[i:i + MAX_IN_PARAMS],
+                                    ('name', 'displayname', 'description', 'rating', 'hash'))
+            tags = _get_patch_tags(session, [row[0] for row in chunk])
+
+            for id_, data, name, displayname, description, rating, hash_ in chunk:
+                member = _get_member_name(displayname, used)
+                writer.add(member, data)
+                manifest.append(dict(file=member, id=id_, name=name, displayname=displayname,
+                                     description=description, rating=rating,
+                                     tags=tags.get(id_, []), hash=hash_))
+
+            if progress:
+                progress(min(i + MAX_IN_PARAMS, total), total)
+
+        writer.add(MANIFEST_NAME, json.dumps(dict(
+            created=datetime.datetime.now().isoformat(timespec='seconds'),
+            patches=manifest), indent=2, ensure_ascii=False).encode('utf-8'))
+
+    log.info("Exported %i patch(es) to archive '%s'.", len(manifest), filename)
+    return len(manifest)
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+#
+# refacedx/archiveio.py
+"""Read SysEx files from and write them to zip and tar archives.
+
+SysEx files in an archive are read into memory one at a time, the archive is never extracted to
+disk. Tar archives, compressed or not, are read sequentially as a stream.
+
+This module does not depend on the patch library database, so it can be used by the MIDI tools.
+
+"""
+
+import logging
+import tarfile
+import time
+import zipfile
+import zlib
+from io import BytesIO
+from os.path import join, splitext
+
+
+__all__ = ('ARCHIVE_FORMATS', 'ArchiveError', 'ArchiveWriter', 'get_archive_format',
+           'is_archive', 'iter_archive', 'write_archive')
+
+log = logging.getLogger(__name__)
+# archive file name extensions and the mode for writing them with tarfile
+ARCHIVE_FORMATS = {
+    '.zip': 'zip',
+    '.tar': 'w',
+    '.tar.gz': 'w:gz',
+    '.tgz': 'w:gz',
+    '.tar.bz2': 'w:bz2',
+    '.tbz2': 'w:bz2',
+    '.tar.xz': 'w:xz',
+    '.txz': 'w:xz',
+}
+# larger archive members are skipped, a Reface DX voice has 241 bytes
+MAX_MEMBER_SIZE = 64 * 1024 * 1024
+_READ_ERRORS = (EOFError, tarfile.TarError, zipfile.BadZipFile, zlib.error)
+
+
+class ArchiveError(OSError):
+    """Raised when an archive is invalid or corrupt."""
+
+
+def get_archive_format(filename):
+    """Return file name extension of archive format of given file name or None."""
+    lower = filename.lower()
+
+    for ext in sorted(ARCHIVE_FORMATS, key=len, reverse=True):
+        if lower.endswith(ext):
+            return ext
+
+
+def is_archive(filename):
+    """Return True if given file name has the extension of a supported archive format."""
+    return get_archive_format(filename) is not None
+
+
+def _is_sysex_member(name):
+    base = name.rsplit('/', 1)[-1]
+    # skip AppleDouble files added to zip archives created on macOS
+    return (splitext(base)[1].lower() == '.syx' and not base.startswith('._') and
+            not name.startswith('__MACOSX/'))
+
+
+def iter_archive(filename):
+    """Yield ``(name, data)`` tuples for the SysEx files in given zip or tar archive.
+
+    ``name`` is the path of the archive member appended to the archive file name. Raises
+    ``ArchiveError`` if the archive is invalid or corrupt, or ``OSError`` if it can not be read.
+
+    """
+    try:
+        if get_archive_format(filename) == '.zip':
+            with zipfile.ZipFile(filename) as zf:
+                for info in zf.infolist():
+                    if info.is_dir() or not _is_sysex_member(info.filename):
+                        continue
+                    elif info.file_size > MAX_MEMBER_SIZE:
+                        log.warning("Skipping large archive member '%s' (%i bytes).",
+                                    info.filename, info.file_size)
+                        continue
+
+                    yield join(filename, info.filename), zf.read(info)
+        else:
+            # stream mode, members are read in order without seeking
+            with tarfile.open(filename, 'r|*') as tf:
+                for member in tf:
+                    if not member.isfile() or not _is_sysex_member(member.name):
+                        continue
+                    elif member.size > MAX_MEMBER_SIZE:
+                        log.warning("Skipping large archive member '%s' (%i bytes).",
+                                    member.name, member.size)
+                        continue
+
+                    yield join(filename, member.name), tf.extractfile(member).read()
+    except _READ_ERRORS as exc:
+        raise ArchiveError("Invalid or corrupt archive: %s" % exc) from exc
+
+
+class ArchiveWriter:
+    """Write members to a zip or tar archive with the same interface.
+
+    The archive format is determined by the file name extension (see ``ARCHIVE_FORMATS``). Use
+    it as a context manager, which closes the archive on exit, e.g.::
+
+        with ArchiveWriter('patches.zip') as writer:
+            writer.add('Cool_Pad.syx', data)
+
+    """
+
+    def __init__(self, filename):
+        mode = ARCHIVE_FORMATS[get_archive_format(filename)]
+
+        if mode == 'zip':
+            self.archive = zipfile.ZipFile(filename, 'w', compression=zipfile.ZIP_DEFLATED)
+        else:
+            self.archive = tarfile.open(filename, mode)
+
+    def add(self, name, data):
+        if isinstance(self.archive, zipfile.ZipFile):
+            self.archive.writestr(name, data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = time.time()
+            info.mode = 0o644
+            self.archive.addfile(info, BytesIO(data))
+
+    def close(self):
+        self.archive.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def write_archive(filename, members):
+    """Write given ``(name, data)`` tuples as members to a zip or tar archive.
+
+    The archive format is determined by the file name extension (see ``ARCHIVE_FORMATS``).
+
+    """
+    with ArchiveWriter(filename) as writer:
+        for name, data in members:
+            writer.add(name, data)
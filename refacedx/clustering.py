@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+#
+# refacedx/clustering.py
+"""Find and merge clusters of near-duplicate patches.
+
+Two patches are near-duplicates, if their voices differ in at most ``max_diff`` voice parameters.
+The voice name is not a voice parameter, so renamed copies of a voice differ in no parameter.
+Near-duplicate relations are transitive here, i.e. clusters are the connected components of the
+graph of near-duplicate pairs.
+
+Instead of comparing all pairs of patches, candidate pairs are found by blocking with the
+pigeonhole principle: if the parameters are split into ``max_diff + 1`` bands, two voices differing
+in at most ``max_diff`` parameters must be equal in at least one band. So the patches are grouped
+by the values of each band, and only patches within the same group are compared. Groups, which are
+still larger than ``block_size``, are split further in the same way by the bands of the parameters
+not compared yet.
+
+Clusters are stored in the ``duplicate_cluster`` and ``duplicate_member`` tables, so they can be
+reviewed and merged later with ``merge_cluster``.
+
+This module needs NumPy (see ``analysis``).
+
+"""
+
+import logging
+import time
+
+import numpy as np
+from sqlalchemy import delete
+from sqlalchemy.orm import selectinload
+
+from .analysis import PARAMS_START, VOICE_DTYPE, load_voice_array
+from .model import DuplicateCluster, DuplicateMember
+
+
+__all__ = ('find_clusters', 'get_clusters', 'merge_cluster', 'store_clusters',
+           'update_clusters')
+
+log = logging.getLogger(__name__)
+# maximum number of patches in a group, which are compared pair-wise
+BLOCK_SIZE = 256
+# fixed permutation of the parameter columns, so parameters of the same operator or envelope,
+# which often have the same values, are spread over the bands
+_COLUMN_ORDER = np.random.RandomState(0).permutation(VOICE_DTYPE.itemsize - PARAMS_START)
+# random multipliers for hashing the values of a set of columns into one integer
+_HASH_WEIGHTS = np.random.RandomState(1).randint(
+    1, 2 ** 62, size=len(_COLUMN_ORDER), dtype=np.int64).astype(np.uint64)
+
+
+def get_param_matrix(voices):
+    """Return 2D byte array view of voice parameter values of structured array of voices."""
+    voices = np.ascontiguousarray(voices)
+    raw = voices.view(np.uint8).reshape(len(voices), VOICE_DTYPE.itemsize)
+    return raw[:, PARAMS_START:]
+
+
+def _group_rows(matrix, rows, columns):
+    """Return list of groups of more than one of given rows, which are equal in given columns.
+
+    Rows are grouped by a hash of their values, which is cheaper to sort than the values
+    themselves. Groups with hash collisions are split by their actual values.
+
+    """
+    keys = matrix[np.ix_(rows, columns)].astype(np.uint64) @ _HASH_WEIGHTS[columns]
+    order = np.argsort(keys, kind='stable')
+    bounds = np.flatnonzero(np.diff(keys[order])) + 1
+    starts = np.concatenate(([0], bounds))
+    ends = np.concatenate((bounds, [len(rows)]))
+    groups = []
+
+    for start, end in zip(starts[ends - starts > 1], ends[ends - starts > 1]):
+        group = rows[order[start:end]]
+        values = matrix[np.ix_(group, columns)]
+
+        if (values == values[0]).all():
+            groups.append(group)
+        else:
+            _, inverse = np.unique(values, axis=0, return_inverse=True)
+            inverse = inverse.ravel()
+            groups.extend(group[inverse == i] for i in range(inverse.max() + 1)
+                          if np.count_nonzero(inverse == i) > 1)
+
+    return groups
+
+
+def _find_pairs(matrix, max_diff, block_size):
+    """Return array of pairs of row indexes of matrix, which are near-duplicates.
+
+    Not all near-duplicate pairs are returned, but enough to connect all rows of each cluster.
+
+    """
+    pairs = [np.empty((0, 2), dtype=np.intp)]
+    stack = [(np.arange(len(matrix)), _COLUMN_ORDER)]
+
+    while stack:
+        # all rows of a group are equal in the columns, which are not in the list
+        rows, columns = stack.pop()
+
+        if len(rows) <= block_size:
+            block = matrix[rows]
+            diffs = (block[:, None, :] != block[None, :, :]).sum(axis=2)
+            first, second = np.nonzero(np.triu(diffs <= max_diff, k=1))
+            pairs.append(np.column_stack((rows[first], rows[second])))
+            continue
+        elif len(columns) <= max_diff:
+            # pairs with the first row are enough to connect the whole group
+            pairs.append(np.column_stack((np.full(len(rows) - 1, rows[0]), rows[1:])))
+            continue
+
+        # rows equal in all columns are near-duplicates of the same rows, so keep only one
+        duplicates = _group_rows(matrix, rows, columns)
+
+        if duplicates:
+            for group in duplicates:
+                pairs.append(np.column_stack((np.full(len(group) - 1, group[0]), group[1:])))
+
+            removed = np.concatenate([group[1:] for group in duplicates])
+            stack.append((np.setdiff1d(rows, removed, assume_unique=True), columns))
+            continue
+
+        for band in np.array_split(columns, max_diff + 1):
+            rest = columns[~np.isin(columns, band)]
+            stack.extend((group, rest) for group in _group_rows(matrix, rows, band))
+
+    return np.unique(np.concatenate(pairs), axis=0)
+
+
+def _connected_components(pairs):
+    """Return list of lists of nodes connected by given pairs, using union-find."""
+    parent = {}
+
+    def find(node):
+        root = node
+
+        while parent.setdefault(root, root) != root:
+            root = parent[root]
+
+        while parent[node] != root:
+            parent[node], node = root, parent[node]
+
+        return root
+
+    for first, second in pairs.tolist():
+        root1, root2 = find(first), find(second)
+
+        if root1 != root2:
+            parent[max(root1, root2)] = min(root1, root2)
+
+    components = {}
+
+    for node in parent:
+        components.setdefault(find(node), []).append(node)
+
+    return list(components.values())
+
+
+def find_clusters(voices, max_diff=1, block_size=BLOCK_SIZE):
+    """Return clusters of near-duplicates in structured array of voices.
+
+    ``voices`` is an array with ``analysis.VOICE_DTYPE``. Returns a list of clusters, largest
+    first. Each cluster is a list of ``(patch_id, diff)`` tuples, where ``diff`` is the number of
+    parameters differing from the first patch of the cluster, which is the one with the lowest id.
+
+    """
+    start = time.perf_counter()
+    matrix = get_param_matrix(voices)
+    pairs = _find_pairs(matrix, max_diff, block_size)
+    clusters = []
+
+    for rows in _connected_components(pairs):
+        rows = np.array(sorted(rows, key=lambda row: voices['patch_id'][row]))
+        diffs = (matrix[rows] != matrix[rows[0]]).sum(axis=1)
+        clusters.append(list(zip(voices['patch_id'][rows].tolist(), diffs.tolist())))
+
+    clusters.sort(key=lambda cluster: (-len(cluster), cluster[0][0]))
+    log.debug("Found %i cluster(s) in %i voice(s) from %i pair(s) in %.3f sec.", len(clusters),
+              len(voices), len(pairs), time.perf_counter() - start)
+    return clusters
+
+
+def store_clusters(session, clusters, max_diff):
+    """Replace the clusters stored in the database with given clusters (see ``find_clusters``)."""
+    with session.begin():
+        session.execute(delete(DuplicateMember.__table__))
+        session.execute(delete(DuplicateCluster.__table__))
+
+        if clusters:
+            session.execute(DuplicateCluster.__table__.insert(),
+                            [dict(id=id_, max_diff=max_diff)
+                             for id_ in range(1, len(clusters) + 1)])
+            session.execute(DuplicateMember.__table__.insert(),
+                            [dict(cluster_id=id_, patch_id=patch_id, diff=diff)
+                             for id_, cluster in enumerate(clusters, 1)
+                             for patch_id, diff in cluster])
+
+
+def update_clusters(session, max_diff=1, block_size=BLOCK_SIZE):
+    """Find clusters of near-duplicates in the whole library and store them in the database.
+
+    Returns the list of clusters found (see ``find_clusters``).
+
+    """
+    clusters = find_clusters(load_voice_array(session), max_diff, block_size)
+    store_clusters(session, clusters, max_diff)
+    log.info("Found %i cluster(s) of near-duplicates with %i patch(es).", len(clusters),
+             sum(len(cluster) for cluster in clusters))
+    return clusters
+
+
+def get_clusters(session):
+    """Return list of stored clusters, which still have more than one member, largest first."""
+    query = session.query(DuplicateCluster).options(
+        selectinload(DuplicateCluster.members).joinedload(DuplicateMember.patch))
+    clusters = query.order_by(DuplicateCluster.id).all()
+    clusters = [cluster for cluster in clusters if len(cluster.members) > 1]
+    clusters.sort(key=lambda cluster: -len(cluster.members))
+    return clusters
+
+
+def merge_cluster(session, cluster_id, keep=None):
+    """Merge the patches of stored cluster with given id into one patch and delete the cluster.
+
+    The patch with the id given by ``keep``, or else the first patch of the cluster, is kept and
+    all other patches are deleted. The kept patch gets the union of the tags of all patches and,
+    if it has none, the description and author of the first other patch, which has one. Its
+    rating is set to the highest rating of all patches.
+
+    Returns the kept ``Patch`` instance. Raises ``ValueError`` if there is no cluster with given
+    id or ``keep`` is not a member of it.
+
+    """
+    with session.begin():
+        cluster = session.query(DuplicateCluster).get(cluster_id)
+
+        if cluster is None:
+            raise ValueError("Cluster #%i does not exist." % cluster_id)
+
+        patches = [member.patch for member in cluster.members]
+
+        if keep is None:
+            kept = patches[0]
+        else:
+            try:
+                kept = next(patch for patch in patches if patch.id == keep)
+            except StopIteration:
+                raise ValueError("Patch #%i is not in cluster #%i." % (keep, cluster_id))
+
+        others = [patch for patch in patches if patch is not kept]
+        ratings = [patch.rating for patch in patches if patch.rating is not None]
+
+        for patch in others:
+            for tag in patch.tags:
+                if tag not in kept.tags:
+                    kept.tags.append(tag)
+
+            if not kept.description and patch.description:
+                kept.description = patch.description
+
+            if kept.author is None and patch.author is not None:
+                kept.author = patch.author
+
+        if ratings:
+            kept.rating = max(ratings)
+
+        # delete the cluster first, the trigger would otherwise delete the member rows
+        session.delete(cluster)
+        session.flush()
+
+        for patch in others:
+            session.delete(patch)
+
+    log.info("Merged %i patch(es) into patch #%i '%s'.", len(others), kept.id, kept.displayname)
+    return kept
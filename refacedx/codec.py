@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+#
+# refacedx/codec.py
+"""Compiled codec for Reface DX voice bulk dump data.
+
+A voice is always dumped as the same sequence of seven bulk dump messages (header, voice common,
+four operators, footer), so every parameter has a fixed offset in the 241 bytes of voice data.
+The tables in ``voiceparams`` are compiled into ``struct.Struct`` instances for these offsets at
+import time, so decoding a voice is a single ``unpack_from`` call and the validation of all
+message headers is a single regular expression match.
+
+``diff`` compares two voices parameter by parameter and returns the address of each changed
+parameter, as used in parameter change messages, i.e. the address of the message containing it
+with the offset of the parameter in the message data as the low byte.
+
+"""
+
+import hashlib
+import re
+import struct
+from collections import namedtuple
+
+from rtmidi.midiconstants import END_OF_EXCLUSIVE, SYSTEM_EXCLUSIVE
+
+from .constants import (ADDRESSES_VOICE_BLOCK, PATCH_NAME_LENGTH, PATCH_NAME_OFFSET,
+                        REFACE_DX_MODEL_ID, YAMAHA_MANUFACTURER_ID)
+from .util import checksum
+from .voiceparams import iter_voice_params
+
+
+__all__ = ('PARAMS', 'VOICE_LENGTH', 'Voice', 'decode', 'diff', 'encode', 'is_voice',
+           'voice_hash')
+
+# length of the data part of each message in a voice bulk dump
+BLOCK_DATA_LENGTHS = (0, 38, 28, 28, 28, 28, 0)
+# offset of the data in a bulk dump message; the checksum and EOX byte follow the data
+DATA_OFFSET = 11
+# voice parameters with a value, see voiceparams.iter_voice_params
+PARAMS = tuple(iter_voice_params())
+
+
+def _get_message_offsets():
+    offsets = []
+    pos = 0
+
+    for length in BLOCK_DATA_LENGTHS:
+        offsets.append(pos)
+        pos += DATA_OFFSET + length + 2
+
+    return tuple(offsets), pos
+
+
+MESSAGE_OFFSETS, VOICE_LENGTH = _get_message_offsets()
+
+
+def _compile_pattern():
+    # F0 43 0n 7F 1C <byte count high> <byte count low> 05 <address> <data> <checksum> F7
+    pattern = b''
+
+    for address, length in zip(ADDRESSES_VOICE_BLOCK, BLOCK_DATA_LENGTHS):
+        size = length + 4
+        pattern += (re.escape(bytes([SYSTEM_EXCLUSIVE, YAMAHA_MANUFACTURER_ID])) +
+                    b'[\\x00-\\x0F]' +
+                    re.escape(bytes([0x7F, 0x1C, size >> 7, size & 0x7F, REFACE_DX_MODEL_ID]) +
+                              bytes(address)) +
+                    b'.{%i}' % (length + 1) +
+                    re.escape(bytes([END_OF_EXCLUSIVE])))
+
+    return re.compile(pattern, re.DOTALL)
+
+
+def _compile_structs():
+    """Return struct for decoding all values and list of (offset, struct, count) for encoding.
+
+    The decoding struct skips the voice name, which is sliced and decoded separately. Encoding
+    packs each contiguous run of values separately, so the message headers and reserved bytes of
+    the target buffer are left alone.
+
+    """
+    fields = [(PATCH_NAME_OFFSET, '%is' % PATCH_NAME_LENGTH, PATCH_NAME_LENGTH)]
+    fields.extend((MESSAGE_OFFSETS[part] + DATA_OFFSET + offset, '?' if type_ is bool else 'B', 1)
+                  for _, part, offset, type_, _ in PARAMS)
+    decode_fmt = '<'
+    runs = []
+    pos = 0
+
+    for offset, fmt, size in fields:
+        if offset == pos and runs:
+            runs[-1][1] += fmt
+            runs[-1][2] += 1
+        else:
+            runs.append([offset, '<' + fmt, 1])
+
+        if offset > pos:
+            decode_fmt += '%ix' % (offset - pos)
+
+        decode_fmt += '%ix' % size if fmt.endswith('s') else fmt
+        pos = offset + size
+
+    return (struct.Struct(decode_fmt),
+            [(offset, struct.Struct(fmt), count) for offset, fmt, count in runs])
+
+
+def _get_param_addresses():
+    """Return tuple of (offset in voice data, parameter address) for each voice parameter.
+
+    Each character of the voice name is a separate parameter.
+
+    """
+    common = MESSAGE_OFFSETS[1] + DATA_OFFSET
+    params = [(common + i, ADDRESSES_VOICE_BLOCK[1][:2] + (i,))
+              for i in range(PATCH_NAME_LENGTH)]
+    params.extend((MESSAGE_OFFSETS[part] + DATA_OFFSET + offset,
+                   ADDRESSES_VOICE_BLOCK[part][:2] + (offset,))
+                  for _, part, offset, _, _ in PARAMS)
+    return tuple(params)
+
+
+VOICE_PATTERN = _compile_pattern()
+DECODER, ENCODERS = _compile_structs()
+PARAM_ADDRESSES = _get_param_addresses()
+
+
+class Voice(namedtuple('Voice', ('name',) + tuple(param[0] for param in PARAMS))):
+    """Decoded voice, i.e. the voice name and the raw values of all voice parameters.
+
+    This is an immutable record, use ``_replace`` to change parameter values.
+
+    """
+    __slots__ = ()
+
+    def params(self):
+        """Return dict of parameter values, without the voice name."""
+        params = self._asdict()
+        del params['name']
+        return params
+
+
+def is_voice(data):
+    """Return True if data is a single Reface DX voice bulk dump."""
+    return VOICE_PATTERN.fullmatch(data) is not None
+
+
+def decode(data):
+    """Decode Reface DX voice SysEx data into a ``Voice`` record.
+
+    Raises ``ValueError`` if data is not a Reface DX voice bulk dump.
+
+    """
+    if VOICE_PATTERN.fullmatch(data) is None:
+        raise ValueError("Not a Reface DX voice bulk dump.")
+
+    name = data[PATCH_NAME_OFFSET:PATCH_NAME_OFFSET + PATCH_NAME_LENGTH]
+    return Voice._make((bytes(name).decode('ascii', 'replace').rstrip(),) +
+                       DECODER.unpack_from(data))
+
+
+def diff(old, new):
+    """Return list of ``(address, value)`` tuples of the parameters of voice new differing in old.
+
+    Both voices are given as Reface DX voice SysEx data. Reserved bytes are not compared. Raises
+    ``ValueError`` if either is not a Reface DX voice bulk dump.
+
+    """
+    if VOICE_PATTERN.fullmatch(old) is None or VOICE_PATTERN.fullmatch(new) is None:
+        raise ValueError("Not a Reface DX voice bulk dump.")
+
+    return [(address, new[offset]) for offset, address in PARAM_ADDRESSES
+            if old[offset] != new[offset]]
+
+
+def encode(voice, template=None, device=0):
+    """Encode ``Voice`` record into Reface DX voice SysEx data.
+
+    If template voice data is given, reserved bytes and the device number are taken from it,
+    otherwise reserved bytes are zero. The checksum of each message is recalculated.
+
+    """
+    if template is None:
+        data = bytearray()
+
+        for address, length in zip(ADDRESSES_VOICE_BLOCK, BLOCK_DATA_LENGTHS):
+            size = length + 4
+            data += bytes([SYSTEM_EXCLUSIVE, YAMAHA_MANUFACTURER_ID, device & 0x0F, 0x7F, 0x1C,
+                           size >> 7, size & 0x7F, REFACE_DX_MODEL_ID])
+            data += bytes(address) + bytes(length + 1) + bytes([END_OF_EXCLUSIVE])
+    elif is_voice(template):
+        data = bytearray(template)
+    else:
+        raise ValueError("Template is not a Reface DX voice bulk dump.")
+
+    values = [voice.name.ljust(PATCH_NAME_LENGTH).encode('ascii', 'replace')[:PATCH_NAME_LENGTH]]
+    values.extend(voice[1:])
+    pos = 0
+
+    for offset, encoder, count in ENCODERS:
+        encoder.pack_into(data, offset, *values[pos:pos + count])
+        pos += count
+
+    for start, length in zip(MESSAGE_OFFSETS, BLOCK_DATA_LENGTHS):
+        end = start + DATA_OFFSET + length
+        data[end] = checksum(data, offset=start + 7, length=end - start - 7)
+
+    return bytes(data)
+
+
+def voice_hash(data):
+    """Return hex digest of the voice parameter payload of Reface DX voice data.
+
+    Gives the same result as ``util.get_voice_hash``, but hashes the data blocks at their fixed
+    offsets. Raises ``ValueError`` if data is not a Reface DX voice bulk dump.
+
+    """
+    if VOICE_PATTERN.fullmatch(data) is None:
+        raise ValueError("Not a Reface DX voice bulk dump.")
+
+    view = memoryview(data)
+    digest = hashlib.sha1()
+
+    for start, length in zip(MESSAGE_OFFSETS, BLOCK_DATA_LENGTHS):
+        digest.update(view[start + DATA_OFFSET:start + DATA_OFFSET + length])
+
+    return digest.hexdigest()
@@ -28,6 +28,7 @@ PARAMETER_CHANGE = bytes([
     0,      # Address high
     0,      # Address mid
     0,      # Address low
+    0,      # Data
     END_OF_EXCLUSIVE
 ])
 
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# refacedx/filethread.py
+
+import logging
+import threading
+from os.path import join
+
+try:
+    from qtpy.QtCore import QSettings, QObject, Qt, Signal, Slot
+except ImportError:
+    from PyQt5.QtCore import QSettings, QObject, Qt, pyqtSignal as Signal, pyqtSlot as Slot
+
+from .archive import export_archive
+from .importer import ImportStats, PatchImporter
+from .model import MAX_IN_PARAMS, Session, load_patch_data
+from .sync import sync_folders
+
+
+log = logging.getLogger(__name__)
+
+
+class FileWorker(QObject):
+    """Background worker for patch import, export and watched folder sync.
+
+    This will be run in a QThread when the application starts. Each job uses its own database
+    session, since SQLite connections must not be shared between threads.
+
+    """
+    import_files = Signal(object)
+    sync_folders = Signal(object, bool)
+    export_patches = Signal(object, str)
+    export_archive = Signal(object, str)
+    job_start = Signal(int)
+    progress = Signal(int, int)
+    file_error = Signal(str, str)
+    batch_committed = Signal(int)
+    import_complete = Signal(object)
+    sync_complete = Signal(object)
+    export_complete = Signal(int)
+
+    def __init__(self, config, *args, **kw):
+        super().__init__(*args, **kw)
+        self.config = QSettings()
+        self._cancel = threading.Event()
+        self.import_files.connect(self._import_files, type=Qt.QueuedConnection)
+        self.sync_folders.connect(self._sync_folders, type=Qt.QueuedConnection)
+        self.export_patches.connect(self._export_patches, type=Qt.QueuedConnection)
+        self.export_archive.connect(self._export_archive, type=Qt.QueuedConnection)
+
+    def cancel(self):
+        """Cancel the running job.
+
+        This must be called directly from the GUI thread, i.e. connected to signals with
+        ``Qt.DirectConnection``, since queued calls would only be delivered after the running job
+        has finished.
+
+        """
+        log.debug("Cancelling file job.")
+        self._cancel.set()
+
+    def _job_failed(self, name, exc):
+        # exceptions must not escape a slot, or the GUI would wait for the job forever
+        log.exception("File job failed: %s", exc)
+        self.file_error.emit(name, str(exc))
+
+    def _get_importer(self, session):
+        return PatchImporter(session,
+                             self.config.value('import/batch_size', 100, type=int),
+                             self.config.value('import/workers', 1, type=int))
+
+    @Slot(object)
+    def _import_files(self, files):
+        self._cancel.clear()
+        total = len(files)
+        self.job_start.emit(total)
+        session = Session()
+        stats = None
+
+        def progress(current):
+            nonlocal stats
+            stats = current
+            self.batch_committed.emit(current.imported)
+            self.progress.emit(current.sources, total)
+
+        try:
+            stats = self._get_importer(session).import_files(
+                files, progress=progress, error=self.file_error.emit, cancel=self._cancel)
+        except Exception as exc:
+            self._job_failed("Import", exc)
+            # patches of batches committed before the error are still reported
+            stats = stats or ImportStats()
+            stats.errors += 1
+        finally:
+            session.close()
+
+        self.import_complete.emit(stats)
+
+    @Slot(object, bool)
+    def _sync_folders(self, folders, recursive):
+        self._cancel.clear()
+        # the number of files is not known in advance, so the progress is indeterminate
+        self.job_start.emit(0)
+        session = Session()
+        stats = None
+
+        def progress(current):
+            nonlocal stats
+            stats = current
+            self.batch_committed.emit(current.imported)
+
+        try:
+            stats = sync_folders(session, folders, self._get_importer(session), recursive,
+                                 progress=progress, error=self.file_error.emit,
+                                 cancel=self._cancel)
+        except Exception as exc:
+            self._job_failed("Sync", exc)
+            stats = stats or ImportStats()
+            stats.errors += 1
+        finally:
+            session.close()
+
+        self.sync_complete.emit(stats)
+
+    @Slot(object, str)
+    def _export_patches(self, ids, directory):
+        self._cancel.clear()
+        total = len(ids)
+        self.job_start.emit(total)
+        session = Session()
+        done = exported = 0
+
+        try:
+            for i in range(0, total, MAX_IN_PARAMS):
+                if self._cancel.is_set():
+                    log.warning("Patch export cancelled.")
+                    break
+
+                chunk = load_patch_data(session, ids[i:i + MAX_IN_PARAMS], ('displayname',))
+
+                for _, data, displayname in chunk:
+                    filename = join(directory, displayname.replace(' ', '_') + '.syx')
+
+                    try:
+                        with open(filename, 'wb') as syx:
+                            syx.write(data)
+                    except OSError as exc:
+                        log.error("Could not write SysEx file at '%s': %s", filename, exc)
+                        self.file_error.emit(filename, str(exc))
+                    else:
+                        exported += 1
+
+                    done += 1
+
+                self.progress.emit(done, total)
+        except Exception as exc:
+            self._job_failed(directory, exc)
+        finally:
+            session.close()
+
+        self.export_complete.emit(exported)
+
+    @Slot(object, str)
+    def _export_archive(self, ids, filename):
+        self._cancel.clear()
+        self.job_start.emit(len(ids))
+        session = Session()
+        exported = 0
+
+        try:
+            exported = export_archive(session, ids, filename, progress=self.progress.emit,
+                                      cancel=self._cancel)
+        except OSError as exc:
+            log.error("Could not write archive '%s': %s", filename, exc)
+            self.file_error.emit(filename, str(exc))
+        except Exception as exc:
+            self._job_failed(filename, exc)
+        finally:
+            session.close()
+
+        self.export_complete.emit(exported)
@@ -0,0 +1,470 @@
+# -*- coding: utf-8 -*-
+#
+# refacedx/importer.py
+"""Bulk import of Reface DX voice SysEx files into the patch library."""
+
+import logging
+import mmap
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from itertools import chain, islice
+from os.path import basename, isdir, join, splitext
+
+from .archiveio import is_archive, iter_archive
+from .constants import ADDRESS_HEADER, ADDRESSES_VOICE_BLOCK
+from .model import Patch, VoiceParams, get_existing_hashes, get_patch_ids
+from .codec import PARAMS, VOICE_PATTERN, decode, voice_hash
+from .util import is_reface_dx_bulk_dump, iter_sysex
+
+
+log = logging.getLogger(__name__)
+INSERT_PARAMS = "INSERT INTO %s (patch_id, %s) VALUES (?%s)" % (
+    VoiceParams.__table__.name, ', '.join(param[0] for param in PARAMS), ', ?' * len(PARAMS))
+
+
+def get_displayname(filename):
+    """Derive a patch display name from a SysEx file name."""
+    return splitext(basename(filename))[0].replace('_', ' ').strip()
+
+
+def is_import_file(filename):
+    """Return True if given file name has the extension of a SysEx file or an archive."""
+    return splitext(filename)[1].lower() == '.syx' or is_archive(filename)
+
+
+def find_files(paths, recursive=False):
+    """Yield file paths given directly and SysEx files and archives found in given directories."""
+    for path in paths:
+        if not isdir(path):
+            yield path
+        elif recursive:
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for filename in sorted(files):
+                    if is_import_file(filename):
+                        yield join(root, filename)
+        else:
+            for filename in sorted(os.listdir(path)):
+                if is_import_file(filename):
+                    yield join(path, filename)
+
+
+@contextmanager
+def map_file(filename):
+    """Return context manager giving a read-only memory map of the contents of given file.
+
+    Empty files and files, which can not be mapped, are read into a bytes object instead.
+
+    """
+    with open(filename, 'rb') as fp:
+        try:
+            data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            data = None
+
+        if data is None:
+            yield fp.read()
+        else:
+            with data:
+                yield data
+
+
+def _assemble_voices(messages):
+    parts = []
+
+    for msg in messages:
+        if is_reface_dx_bulk_dump(msg, address=ADDRESSES_VOICE_BLOCK[len(parts)]):
+            parts.append(msg)
+        elif is_reface_dx_bulk_dump(msg):
+            if parts:
+                log.debug("Skipping incomplete voice dump with %i message(s).", len(parts))
+
+            parts = [msg] if is_reface_dx_bulk_dump(msg, address=ADDRESS_HEADER) else []
+            continue
+        else:
+            continue
+
+        if len(parts) == len(ADDRESSES_VOICE_BLOCK):
+            yield b''.join(parts)
+            parts = []
+
+    if parts:
+        log.debug("Skipping incomplete voice dump with %i message(s).", len(parts))
+
+
+def iter_voices(source):
+    """Yield data of each complete voice bulk dump in given SysEx data or binary file.
+
+    The messages are read with ``util.iter_sysex``, so ``source`` may be e.g. an ``mmap`` and
+    only the data of each voice found is copied. A voice is a sequence of Reface DX bulk dump
+    messages with the addresses in ``ADDRESSES_VOICE_BLOCK``. Other SysEx messages between
+    voices or their messages, e.g. in captured MIDI logs, are ignored. Incomplete voices are
+    skipped.
+
+    In buffers, runs of consecutive voices are found with the compiled ``codec.VOICE_PATTERN``
+    and only the data between them is split into messages.
+
+    The generator should be closed or exhausted before a memory map passed to it is closed.
+
+    """
+    try:
+        view = memoryview(source).cast('B')
+    except TypeError:
+        yield from _assemble_voices(iter_sysex(source))
+        return
+
+    pos = 0
+
+    while pos < len(view):
+        match = VOICE_PATTERN.search(view, pos)
+        end = match.start() if match else len(view)
+
+        if end > pos:
+            yield from _assemble_voices(iter_sysex(view[pos:end], offset=pos))
+
+        if match is None:
+            break
+
+        yield bytes(view[end:match.end()])
+        pos = match.end()
+
+
+class ImportStats:
+    """Counters for a running or finished bulk import."""
+
+    def __init__(self):
+        # files and archives given to the importer, which were read
+        self.sources = 0
+        # SysEx files read, i.e. including each SysEx file in an archive
+        self.files = 0
+        self.voices = 0
+        self.imported = 0
+        self.duplicates = 0
+        self.invalid = 0
+        self.errors = 0
+        self.batches = 0
+        # files skipped by a sync, because they did not change (see ``sync``)
+        self.unchanged = 0
+        self.cancelled = False
+        self.start = time.perf_counter()
+        self.elapsed = 0.0
+
+    def __repr__(self):
+        return ("<ImportStats(files=%i, voices=%i, imported=%i, duplicates=%i, invalid=%i, "
+                "errors=%i, elapsed=%.2f)>" % (self.files, self.voices, self.imported,
+                                               self.duplicates, self.invalid, self.errors,
+                                               self.elapsed))
+
+    @property
+    def rate(self):
+        return self.files / self.elapsed if self.elapsed else 0.0
+
+
+def _decode_voices(voices):
+    """Yield (data, name, hash, values) for each valid voice in iterable of voice data.
+
+    ``values`` is the tuple of the voice parameter values in the order of ``codec.PARAMS``.
+
+    """
+    for data in voices:
+        try:
+            voice = decode(data)
+        except ValueError:
+            log.warning("Skipping invalid voice dump.")
+            continue
+
+        yield data, voice.name, voice_hash(data), voice[1:]
+
+
+def _iter_archive_members(filename):
+    """Yield ``(name, records)`` for each SysEx file in given archive (see ``iter_archive``)."""
+    for name, data in iter_archive(filename):
+        yield name, _decode_voices(iter_voices(data))
+
+
+def scan_files(filenames):
+    """Read, validate, decode and hash the voices in given files.
+
+    Returns a list of ``(filename, members, error)`` tuples, where ``members`` is a list of
+    ``(name, records)`` tuples, one for a SysEx file and one per SysEx file in an archive, or
+    None, if the file could not be read, in which case ``error`` is the error message. ``records``
+    is a list of ``(data, name, hash, values)`` tuples (see ``_decode_voices``).
+
+    This is the task run by the worker processes of a parallel import.
+
+    """
+    results = []
+
+    for filename in filenames:
+        try:
+            if is_archive(filename):
+                members = [(name, list(records))
+                           for name, records in _iter_archive_members(filename)]
+            else:
+                with map_file(filename) as data:
+                    voices = iter_voices(data)
+
+                    try:
+                        members = [(filename, list(_decode_voices(voices)))]
+                    finally:
+                        voices.close()
+        except OSError as exc:
+            results.append((filename, None, str(exc)))
+        else:
+            results.append((filename, members, None))
+
+    return results
+
+
+class PatchImporter:
+    """Import voice SysEx files into the patch table in batches.
+
+    Each file is memory-mapped and all voices in it are found with ``iter_voices``, so files
+    may contain any number of voices, e.g. whole banks or captured SysEx logs, and are never
+    read into memory as a whole. The voices are validated and decoded with ``codec.decode``
+    and collected into batches of row dictionaries. Rows whose voice hash is already in the
+    library or was already seen in the same run are skipped. Each batch is written with a single
+    Core ``executemany`` INSERT in its own transaction, so no ORM objects are created. The
+    decoded voice parameters are inserted into the ``voice_params`` table in the same
+    transaction.
+
+    Zip and tar archives are read with ``archive.iter_archive`` and each SysEx file in them is
+    imported like a file on disk, without extracting the archive.
+
+    With ``workers`` > 1, files are read, validated, decoded and hashed by ``scan_files`` in a
+    pool of worker processes, in chunks of ``chunk_size`` files. The results are passed back
+    in order to the calling thread, which is the only one writing to the database. At most two
+    chunks per worker are in progress at any time, to limit the memory used for results not
+    written yet. Since a worker returns all voices of a file at once, large bank or capture
+    files use more memory than in a serial import.
+
+    """
+
+    def __init__(self, session, batch_size=500, workers=1, chunk_size=100):
+        self.session = session
+        self.batch_size = batch_size
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+
+    def import_files(self, files, progress=None, error=None, cancel=None, done=None):
+        """Import given SysEx files and archives and return an ``ImportStats`` instance.
+
+        Patches from files containing a single voice are named after the file, patches from
+        files with several voices are named after the voice.
+
+        If ``progress`` is given, it is called after each batch with the stats object. Its
+        ``sources`` attribute counts the given files and archives read so far, while ``files``
+        counts each SysEx file in an archive separately.
+
+        If ``error`` is given, it is called with the file name and an error message for each
+        file, which could not be read or does not contain a valid voice.
+
+        If ``done`` is given, it is called with the file name and the number of voices found for
+        each file or archive, which was read completely, even if it contains no valid voice.
+
+        ``cancel`` may be a ``threading.Event``. When it is set, no further voices are read, but
+        the patches collected so far are still written.
+
+        """
+        stats = ImportStats()
+        self._seen = set()
+        self._batch = []
+        self._params = {}
+
+        if self.workers > 1:
+            self._import_parallel(files, stats, progress, error, cancel, done)
+        else:
+            self._import_serial(files, stats, progress, error, cancel, done)
+
+        if stats.cancelled:
+            log.info("Patch import cancelled.")
+
+        if self._batch:
+            self._write_batch(self._batch, self._params, stats, progress)
+
+        stats.elapsed = time.perf_counter() - stats.start
+        log.info("Imported %i of %i voice(s) from %i file(s) in %.2f sec. (%i duplicate(s), "
+                 "%i invalid, %i error(s)).", stats.imported, stats.voices, stats.files,
+                 stats.elapsed, stats.duplicates, stats.invalid, stats.errors)
+        return stats
+
+    def _import_serial(self, files, stats, progress=None, error=None, cancel=None, done=None):
+        for filename in files:
+            if cancel is not None and cancel.is_set():
+                stats.cancelled = True
+                break
+
+            try:
+                if is_archive(filename):
+                    self._add_source(filename, _iter_archive_members(filename), stats, progress,
+                                     error, cancel, done)
+                    continue
+
+                with map_file(filename) as data:
+                    voices = iter_voices(data)
+
+                    try:
+                        self._add_source(filename, [(filename, _decode_voices(voices))], stats,
+                                         progress, error, cancel, done)
+                    finally:
+                        # release the views of the memory map before it is closed
+                        voices.close()
+            except OSError as exc:
+                self._add_source(filename, None, stats, error=error, message=str(exc))
+
+    def _import_parallel(self, files, stats, progress=None, error=None, cancel=None,
+                         done=None):
+        files = iter(files)
+        pending = deque()
+        log.debug("Reading files in %i worker processes.", self.workers)
+
+        # the importer may run in a thread of a multi-threaded process, e.g. the GUI, which is
+        # not safe to fork
+        context = multiprocessing.get_context('spawn')
+
+        with ProcessPoolExecutor(self.workers, mp_context=context) as executor:
+            while True:
+                while len(pending) < 2 * self.workers:
+                    chunk = list(islice(files, self.chunk_size))
+
+                    if not chunk:
+                        break
+
+                    pending.append(executor.submit(scan_files, chunk))
+
+                if not pending:
+                    break
+
+                for filename, members, message in pending.popleft().result():
+                    if cancel is not None and cancel.is_set():
+                        stats.cancelled = True
+                        break
+
+                    self._add_source(filename, members, stats, progress, error, cancel, done,
+                                     message)
+
+                if stats.cancelled:
+                    for future in pending:
+                        future.cancel()
+
+                    break
+
+    def _add_source(self, filename, members, stats, progress=None, error=None, cancel=None,
+                    done=None, message=None):
+        """Add voice records from given SysEx file or archive to the current batch.
+
+        ``members`` is an iterable of ``(name, records)`` tuples (see ``scan_files``) or None, if
+        the file could not be read, in which case ``message`` is the error message.
+
+        """
+        stats.sources += 1
+
+        if members is None:
+            log.error("Could not read SysEx file '%s': %s", filename, message)
+            stats.files += 1
+            stats.errors += 1
+
+            if error:
+                error(filename, message)
+
+            return
+
+        found = 0
+        empty = True
+
+        for name, records in members:
+            count = self._add_file(name, records, stats, progress, error, cancel)
+            empty = False
+
+            if count is None:
+                return
+
+            found += count
+
+        if empty:
+            # archive without SysEx files
+            self._add_file(filename, (), stats, error=error)
+
+        if done:
+            done(filename, found)
+
+    def _add_file(self, filename, records, stats, progress=None, error=None, cancel=None):
+        """Add given voice records (see ``_decode_voices``) from given file to the current batch.
+
+        Returns the number of voices found or None, if the import was cancelled.
+
+        """
+        stats.files += 1
+        records = iter(records)
+        # look ahead one voice to tell single voice files from banks
+        first, second = next(records, None), next(records, None)
+        displayname = get_displayname(filename)
+        bank = second is not None
+        found = 0
+
+        for record in chain(filter(None, (first, second)), records):
+            if cancel is not None and cancel.is_set():
+                stats.cancelled = True
+                return None
+
+            self._add_record(record, displayname, bank, stats, progress)
+            found += 1
+
+        if not found:
+            log.debug("Not a Reface DX voice file: %s", filename)
+            stats.invalid += 1
+
+            if error:
+                error(filename, "Not a Reface DX voice SysEx file.")
+
+        return found
+
+    def _add_record(self, record, displayname, bank, stats, progress=None):
+        data, name, hash_, values = record
+        stats.voices += 1
+
+        if hash_ in self._seen:
+            stats.duplicates += 1
+            return
+
+        if bank and name:
+            displayname = name
+
+        self._seen.add(hash_)
+        self._batch.append(dict(name=name, displayname=displayname, data=data, hash=hash_))
+        self._params[hash_] = values
+
+        if len(self._batch) >= self.batch_size:
+            self._write_batch(self._batch, self._params, stats, progress)
+            self._batch = []
+            self._params = {}
+
+    def _write_batch(self, batch, params, stats, progress=None):
+        start = time.perf_counter()
+        # one transaction, i.e. database connection, per batch
+        with self.session.begin():
+            existing = get_existing_hashes(self.session, (row['hash'] for row in batch))
+            rows = [row for row in batch if row['hash'] not in existing]
+
+            if rows:
+                self.session.execute(Patch.__table__.insert(), rows)
+                ids = get_patch_ids(self.session, (row['hash'] for row in rows))
+                # plain DB-API executemany, the parameter values need no conversion
+                self.session.connection().execute(
+                    INSERT_PARAMS, [(id_,) + params[hash_] for hash_, id_ in ids.items()])
+
+        elapsed = time.perf_counter() - start
+        stats.batches += 1
+        stats.imported += len(rows)
+        stats.duplicates += len(existing)
+        stats.elapsed = time.perf_counter() - stats.start
+        log.info("Batch #%i: %i patch(es) written, %i duplicate(s) in %.3f sec. "
+                 "(%.0f patches/sec.)", stats.batches, len(rows), len(existing), elapsed,
+                 len(batch) / elapsed if elapsed else 0.0)
+
+        if progress:
+            progress(stats)
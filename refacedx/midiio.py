@@ -4,14 +4,17 @@
 # refacedx/midiio.py
 
 import logging
+import time
 
+from collections import Counter
 from os.path import join
 from queue import Empty, Queue
 
 from rtmidi.midiconstants import PROGRAM_CHANGE, SYSTEM_EXCLUSIVE
 
-from .constants import ADDRESS_HEADER, ADDRESSES_VOICE_BLOCK, DUMP_REQUEST
-from .util import is_reface_dx_bulk_dump, split_sysex
+from .codec import VOICE_LENGTH, diff, is_voice
+from .constants import ADDRESS_HEADER, ADDRESSES_VOICE_BLOCK, DUMP_REQUEST, PARAMETER_CHANGE
+from .util import has_valid_checksum, is_reface_dx_bulk_dump, iter_sysex
 
 
 log = logging.getLogger(__name__)
@@ -22,15 +25,166 @@ class TimeoutError(Exception):
     pass
 
 
+class ChecksumError(TimeoutError):
+    """Raised when a block of a voice dump is still corrupt after requesting it again.
+
+    It is a subclass of ``TimeoutError``, since in both cases no valid patch was received.
+
+    """
+    pass
+
+
+class LatencyEstimator:
+    """Running estimate of the latency of MIDI replies and a timeout derived from it.
+
+    Like the TCP retransmission timer (RFC 6298), the smoothed mean and mean deviation of the
+    measured latencies are kept and the timeout is the mean plus four times the deviation,
+    limited to ``min_timeout`` and ``max_timeout``. Until the first measurement, the timeout is
+    ``max_timeout``. After each timeout it is doubled, so a slow device is not given up on
+    repeatedly.
+
+    """
+
+    def __init__(self, max_timeout=5.0, min_timeout=0.1):
+        self.max_timeout = max_timeout
+        self.min_timeout = min(min_timeout, max_timeout)
+        self.mean = None
+        self.deviation = None
+        self.timeout = max_timeout
+
+    def __repr__(self):
+        return "<LatencyEstimator(mean=%s, deviation=%s, timeout=%.3f)>" % (
+            self.mean, self.deviation, self.timeout)
+
+    def add(self, latency):
+        """Add measured latency in seconds and update the timeout."""
+        if self.mean is None:
+            self.mean = latency
+            self.deviation = latency / 2
+        else:
+            self.deviation = 0.75 * self.deviation + 0.25 * abs(self.mean - latency)
+            self.mean = 0.875 * self.mean + 0.125 * latency
+
+        self.timeout = max(self.min_timeout,
+                           min(self.max_timeout, self.mean + 4 * self.deviation))
+
+    def backoff(self):
+        """Double the timeout after it expired."""
+        self.timeout = min(self.max_timeout, self.timeout * 2)
+
+
+class VoiceDumpCollector:
+    """Collect the blocks of a voice dump, verifying the checksum of each as it arrives.
+
+    Blocks may arrive in any order, e.g. when a corrupt block was requested again, and are
+    assembled in the order of ``ADDRESSES_VOICE_BLOCK``. The number of blocks received, including
+    corrupt ones, is counted in ``received`` and the number of corrupt blocks per address in
+    ``corrupt``. Ignored messages are not counted.
+
+    """
+
+    def __init__(self, max_retries=2):
+        self.max_retries = max_retries
+        self.blocks = {}
+        self.received = 0
+        self.corrupt = Counter()
+
+    @property
+    def complete(self):
+        return len(self.blocks) == len(ADDRESSES_VOICE_BLOCK)
+
+    def add(self, msg):
+        """Add received SysEx message.
+
+        Returns the address of the block, if its checksum is wrong and it should be requested
+        again, otherwise None. Messages, which are no blocks of a voice dump, and blocks already
+        received are ignored. Raises ``ChecksumError`` if a block is corrupt more than
+        ``max_retries`` times.
+
+        """
+        address = tuple(msg[8:11]) if is_reface_dx_bulk_dump(msg) else None
+
+        if address not in ADDRESSES_VOICE_BLOCK or address in self.blocks:
+            log.debug("Ignoring unexpected SysEx message: %r", bytes(msg[:11]))
+            return None
+
+        self.received += 1
+
+        if not has_valid_checksum(msg):
+            self.corrupt[address] += 1
+            log.warning("Checksum error in voice dump block with address %02X %02X %02X.",
+                        *address)
+
+            if self.corrupt[address] > self.max_retries:
+                raise ChecksumError("Voice dump block with address %02X %02X %02X corrupt %i "
+                                    "time(s)." % (address + (self.corrupt[address],)))
+
+            return address
+
+        self.blocks[address] = bytes(msg)
+        return None
+
+    def get_patch(self):
+        """Return the bulk dump data of the complete voice."""
+        return bytearray(b''.join(self.blocks[address] for address in ADDRESSES_VOICE_BLOCK))
+
+
+def get_parameter_changes(old, new, device=0):
+    """Return list of parameter change messages changing voice old on the device into voice new.
+
+    Both voices are given as Reface DX voice SysEx data. Returns None if ``old`` is None or the
+    messages would be longer in total than a bulk dump of the new voice.
+
+    """
+    if old is None:
+        return None
+
+    changes = diff(old, new)
+
+    if len(changes) * len(PARAMETER_CHANGE) >= VOICE_LENGTH:
+        return None
+
+    messages = []
+
+    for address, value in changes:
+        msg = bytearray(PARAMETER_CHANGE)
+        msg[2] |= device
+        msg[6:9] = address
+        msg[9] = value
+        messages.append(msg)
+
+    return messages
+
+
 class RefaceDX:
+    """Client for a Reface DX connected to a pair of rtmidi ports.
+
+    The latency of the first block of a voice dump after the request and of each following block
+    are measured for the ports in use. Patch requests wait for each block only as long as derived
+    from these measurements (see ``LatencyEstimator``), but at most ``timeout`` seconds.
+
+    The checksum of each block is verified and a corrupt block is requested again on its own, up
+    to ``max_retries`` times. The numbers of blocks received and of corrupt blocks per address are
+    counted for the ports in use in ``received_blocks`` and ``corrupt_blocks``.
 
-    def __init__(self, midiin=None, midiout=None, device=0, channel=0, timeout=5.0, debug=False):
+    The voice last sent to or received from the device is kept in ``edit_buffer``, as a shadow
+    copy of the edit buffer of the device. If ``send_changes`` is enabled, only the parameters of a
+    voice, which differ from it, are sent with parameter change messages (see ``send_patch``).
+    Voices edited on the device itself are not noticed, so set ``edit_buffer`` to None then.
+
+    """
+
+    def __init__(self, midiin=None, midiout=None, device=0, channel=0, timeout=5.0, debug=False,
+                 max_retries=2, send_changes=False):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.send_changes = send_changes
+        self._midiin = None
         self.midiin = midiin
         self.midiout = midiout
         self.device = device
         self.channel = channel
         self.debug = debug
-        self.timeout = timeout
         self.queue = Queue()
 
     @property
@@ -40,13 +194,31 @@ class RefaceDX:
     @midiin.setter
     def midiin(self, value):
         self._midiin = value
+        self.reset_stats()
         if self._midiin:
             self._midiin.ignore_types(sysex=False)
             self._midiin.set_callback(self._msg_callback)
 
+    @property
+    def midiout(self):
+        return self._midiout
+
+    @midiout.setter
+    def midiout(self, value):
+        self._midiout = value
+        self.edit_buffer = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Forget the latencies measured and corrupt blocks counted, e.g. when the ports change."""
+        self.first_latency = LatencyEstimator(self.timeout)
+        self.block_latency = LatencyEstimator(self.timeout)
+        self.received_blocks = 0
+        self.corrupt_blocks = Counter()
+
     def _send(self, msg):
         if self.debug:
-            log.debug("MIDI SEND: %r", msg)
+            log.debug("MIDI SEND: %r", bytes(msg))
         if self.midiout:
             self.midiout.send_message(msg)
 
@@ -60,36 +232,87 @@ class RefaceDX:
         msg[8] = address[2]
         self._send(msg)
 
-    def patch_request(self, device=None):
+    def patch_request(self, device=None, timeout=None):
+        """Request the voice in the edit buffer of the device and return its bulk dump data.
+
+        If ``timeout`` is given, it is used for each block instead of the adaptive timeouts.
+        Raises ``TimeoutError`` if a block is not received within the timeout or
+        ``ChecksumError`` if a block is still corrupt after requesting it again.
+
+        """
+        # discard late replies to earlier requests, which timed out
+        while not self.queue.empty():
+            self.queue.get_nowait()
         self.dump_request(device=device, address=ADDRESS_HEADER)
-        patch = bytearray()
+        collector = VoiceDumpCollector(self.max_retries)
+        estimator = self.first_latency
+        retrying = False
+        last = time.perf_counter()
         try:
-            for address in ADDRESSES_VOICE_BLOCK:
-                part = self.queue.get(timeout=self.timeout)
-                if is_reface_dx_bulk_dump(part, address=address):
-                    patch += bytearray(part)
-        except Empty:
-            raise TimeoutError("No valid patch received within timeout (%s sec.)" % self.timeout)
-        else:
-            return patch
+            while not collector.complete:
+                wait = estimator.timeout if timeout is None else timeout
+                try:
+                    part, received = self.queue.get(timeout=wait)
+                except Empty:
+                    if timeout is None:
+                        estimator.backoff()
+                    raise TimeoutError("No valid patch received within timeout (%.3f sec.)" %
+                                       wait)
+                # replies to a block requested again may interleave with the remaining blocks
+                if not retrying:
+                    estimator.add(received - last)
+                last = received
+                address = collector.add(part)
+                if address is not None:
+                    self.dump_request(address=address, device=device)
+                    retrying = True
+                    estimator = self.first_latency
+                elif not retrying:
+                    estimator = self.block_latency
+        finally:
+            self.received_blocks += collector.received
+            self.corrupt_blocks.update(collector.corrupt)
+        log.debug("Latency: first block %r, other blocks %r", self.first_latency,
+                  self.block_latency)
+        patch = collector.get_patch()
+        self.edit_buffer = bytes(patch)
+        return patch
 
     def _msg_callback(self, event, data):
         msg, delta = event
         if msg[0] == SYSTEM_EXCLUSIVE:
             if self.debug:
                 log.debug("MIDI RECV: %r", msg)
-            self.queue.put(msg)
+            self.queue.put((msg, time.perf_counter()))
 
     def send_patch(self, data):
-        for msg in split_sysex(data):
-            self._send(msg)
+        """Send all SysEx messages in given data or binary file object.
+
+        If ``send_changes`` is enabled and data is a single voice, only the parameters differing
+        from ``edit_buffer`` are sent, unless a bulk dump of the voice is shorter.
+
+        """
+        voice = isinstance(data, (bytes, bytearray)) and is_voice(data)
+        changes = None
+        if self.send_changes and voice:
+            changes = get_parameter_changes(self.edit_buffer, data, self.device)
+        if changes is not None:
+            log.debug("Sending %i parameter change(s) instead of bulk dump.", len(changes))
+            for msg in changes:
+                self._send(msg)
+        else:
+            for msg in iter_sysex(data):
+                self._send(msg)
+        self.edit_buffer = bytes(data) if voice else None
 
     def send_patchfile(self, *names):
         path = join(*names)
         with open(path, 'rb') as syx:
-            self.send_patch(syx.read())
+            self.send_patch(syx)
 
     def send_program_change(self, program, channel=None):
         if channel is None:
             channel = self.channel
         self._send([PROGRAM_CHANGE | (channel & 0xF), program & 0x7F])
+        # the device loads the voice of the program into its edit buffer
+        self.edit_buffer = None
@@ -47,8 +47,8 @@ class MidiWorker(QObject):
         self._midiout = None
         self._midiout_name = None
         self.client_name = self.config.value('midi/client_name', 'Reface DX Lib')
-        self.device = self.config.value('midi/sysex_device', 0)
-        self.channel = self.config.value('midi/channel', 0)
+        self.device = self.config.value('midi/sysex_device', 0, type=int)
+        self.channel = self.config.value('midi/channel', 0, type=int)
         self.close.connect(self._close)
         self.set_input_port.connect(self._set_input_port)
         self.set_output_port.connect(self._set_output_port)
@@ -59,7 +59,10 @@ class MidiWorker(QObject):
     @Slot()
     def initialize(self):
         log.debug('Initializing MidiWorker.')
-        self.midiio = RefaceDX(channel=self.channel)
+        self.midiio = RefaceDX(
+            device=self.device,
+            channel=self.channel,
+            send_changes=self.config.value('midi/send_changes', False, type=bool))
         self.set_input_port.emit(self.config.value('midi/input_port', 'reface DX'))
         self.set_output_port.emit(self.config.value('midi/output_port', 'reface DX'))
         self._scan_ports(init=True)
@@ -169,11 +172,16 @@ class MidiWorker(QObject):
             log.debug("Requesting current patch.")
             patch = self.midiio.patch_request(self.device)
         except TimeoutError as exc:
-            log.error("Patch request timed out.")
+            log.error("Patch request failed: %s", exc)
             self.recv_patch_failed.emit(str(exc))
         else:
             log.debug("Patch data received.")
             self.recv_patch_complete.emit(patch)
+        finally:
+            corrupt = sum(self.midiio.corrupt_blocks.values())
+            if corrupt:
+                log.info("%i of %i block(s) received from '%s' had a checksum error.", corrupt,
+                         self.midiio.received_blocks, self._midiin_name)
 
     @Slot(bytes)
     def _send_patch(self, data):
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+#
+# refacedx/migrations.py
+"""Versioned schema migrations for the patch library database.
+
+The schema version of a database is stored in SQLite's ``user_version`` header field. ``initdb``
+creates missing tables with ``create_all`` and then calls ``upgrade``, which runs all migrations
+with a higher version number in order.
+
+Since fresh databases start at version 0 too, migrations must be idempotent, i.e. check whether
+a column exists before adding it, use ``IF NOT EXISTS`` etc.
+
+"""
+
+import logging
+
+from sqlalchemy import inspect
+
+from .codec import PARAMS, decode
+from .util import get_voice_hash
+
+
+log = logging.getLogger(__name__)
+MIGRATIONS = []
+
+
+def migration(version):
+    """Register decorated function as the migration to given schema version."""
+    def decorator(func):
+        MIGRATIONS.append((version, func))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return func
+    return decorator
+
+
+def get_schema_version(conn):
+    return conn.execute("PRAGMA user_version").scalar()
+
+
+def set_schema_version(conn, version):
+    conn.execute("PRAGMA user_version = %i" % version)
+
+
+def upgrade(conn):
+    """Run all pending migrations on given connection, which should be in a transaction."""
+    current = get_schema_version(conn)
+
+    for version, func in MIGRATIONS:
+        if version > current:
+            log.info("Migrating database schema to version %i: %s", version,
+                     func.__doc__.splitlines()[0])
+            func(conn)
+            set_schema_version(conn, version)
+            current = version
+
+    return current
+
+
+@migration(1)
+def add_patch_hash(conn):
+    """Add voice hash column to patch table.
+
+    If the library already contains duplicate voices, only the oldest patch of each group of
+    duplicates gets the hash set, since the column has a unique index.
+
+    """
+    if 'hash' in (col['name'] for col in inspect(conn).get_columns('patch')):
+        return
+
+    conn.execute("ALTER TABLE patch ADD COLUMN hash VARCHAR(40)")
+    seen = set()
+    updates = []
+
+    for id_, data in conn.execute("SELECT id, data FROM patch ORDER BY id"):
+        hash_ = get_voice_hash(data)
+
+        if hash_ in seen:
+            log.warning("Patch #%i is a duplicate of another patch in the library.", id_)
+        else:
+            seen.add(hash_)
+            updates.append((hash_, id_))
+
+    if updates:
+        conn.execute("UPDATE patch SET hash = ? WHERE id = ?", updates)
+
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS ix_patch_hash ON patch (hash)")
+
+
+@migration(2)
+def add_list_indexes(conn):
+    """Add indexes for sorting and filtering the patch list."""
+    for name, table, columns in (
+            ('ix_patch_displayname', 'patch', 'displayname'),
+            ('ix_patch_name', 'patch', 'name'),
+            ('ix_patch_created', 'patch', 'created'),
+            ('ix_patch_rating', 'patch', 'rating'),
+            ('ix_patch_author_id', 'patch', 'author_id'),
+            ('ix_author_name', 'author', 'name'),
+            ('ix_patch_tag_tag_id', 'patch_tag', 'tag_id')):
+        conn.execute("CREATE INDEX IF NOT EXISTS %s ON %s (%s)" % (name, table, columns))
+
+    # patch_tag had no key, so remove duplicate assignments before adding a unique index
+    conn.execute("DELETE FROM patch_tag WHERE rowid NOT IN "
+                 "(SELECT min(rowid) FROM patch_tag GROUP BY patch_id, tag_id)")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS ix_patch_tag ON patch_tag (patch_id, tag_id)")
+    conn.execute("ANALYZE")
+
+
+@migration(3)
+def add_patch_fts(conn):
+    """Add full-text search index over patch names, descriptions and tags.
+
+    The FTS5 table is kept up-to-date by triggers, so it also covers rows inserted or changed
+    with plain SQL statements, e.g. by the bulk importer.
+
+    """
+    tags = ("(SELECT group_concat(tag.name, ' ') FROM patch_tag JOIN tag ON tag.id = "
+            "patch_tag.tag_id WHERE patch_tag.patch_id = {})")
+    conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS patch_fts USING fts5("
+                 "displayname, name, description, tags, prefix='2 3')")
+
+    for statement in (
+            "CREATE TRIGGER IF NOT EXISTS patch_fts_insert AFTER INSERT ON patch BEGIN "
+            "INSERT INTO patch_fts (rowid, displayname, name, description, tags) "
+            "VALUES (new.id, new.displayname, new.name, new.description, ''); END",
+            "CREATE TRIGGER IF NOT EXISTS patch_fts_update "
+            "AFTER UPDATE OF displayname, name, description ON patch BEGIN "
+            "UPDATE patch_fts SET displayname = new.displayname, name = new.name, "
+            "description = new.description WHERE rowid = new.id; END",
+            "CREATE TRIGGER IF NOT EXISTS patch_fts_delete AFTER DELETE ON patch BEGIN "
+            "DELETE FROM patch_fts WHERE rowid = old.id; END",
+            "CREATE TRIGGER IF NOT EXISTS patch_tag_fts_insert AFTER INSERT ON patch_tag BEGIN "
+            "UPDATE patch_fts SET tags = coalesce(%s, '') WHERE rowid = new.patch_id; END"
+            % tags.format('new.patch_id'),
+            "CREATE TRIGGER IF NOT EXISTS patch_tag_fts_delete AFTER DELETE ON patch_tag BEGIN "
+            "UPDATE patch_fts SET tags = coalesce(%s, '') WHERE rowid = old.patch_id; END"
+            % tags.format('old.patch_id'),
+            "CREATE TRIGGER IF NOT EXISTS tag_fts_update AFTER UPDATE OF name ON tag BEGIN "
+            "UPDATE patch_fts SET tags = coalesce(%s, '') WHERE rowid IN "
+            "(SELECT patch_id FROM patch_tag WHERE tag_id = new.id); END"
+            % tags.format('patch_fts.rowid')):
+        conn.execute(statement)
+
+    conn.execute("DELETE FROM patch_fts")
+    conn.execute("INSERT INTO patch_fts (rowid, displayname, name, description, tags) "
+                 "SELECT id, displayname, name, description, coalesce(%s, '') FROM patch"
+                 % tags.format('patch.id'))
+
+
+@migration(4)
+def add_voice_params(conn, chunk_size=1000):
+    """Add decoded voice parameters of existing patches to voice_params table.
+
+    The table itself is created by ``create_all``. Patches are decoded in chunks of
+    ``chunk_size`` rows, so the whole library is never held in memory.
+
+    """
+    conn.execute("CREATE TRIGGER IF NOT EXISTS voice_params_delete AFTER DELETE ON patch BEGIN "
+                 "DELETE FROM voice_params WHERE patch_id = old.id; END")
+    names = ['patch_id'] + [param[0] for param in PARAMS]
+    insert = "INSERT INTO voice_params (%s) VALUES (%s)" % (
+        ', '.join(names), ', '.join(':' + name for name in names))
+    last_id = 0
+    total = 0
+
+    while True:
+        rows = conn.execute(
+            "SELECT id, data FROM patch WHERE id > ? AND id NOT IN "
+            "(SELECT patch_id FROM voice_params) ORDER BY id LIMIT ?",
+            (last_id, chunk_size)).fetchall()
+
+        if not rows:
+            break
+
+        values = []
+
+        for id_, data in rows:
+            try:
+                params = decode(data).params()
+            except ValueError:
+                log.warning("Patch #%i does not contain valid voice data.", id_)
+            else:
+                params['patch_id'] = id_
+                values.append(params)
+
+        if values:
+            conn.execute(insert, values)
+
+        last_id = rows[-1][0]
+        total += len(values)
+        log.debug("Decoded voice parameters of %i patch(es).", total)
+
+    conn.execute("ANALYZE voice_params")
+
+
+@migration(5)
+def add_patch_data_version(conn):
+    """Add counter of changes to patch data.
+
+    The counter is incremented by triggers whenever a patch is added or deleted or its data
+    changes, so caches of data derived from all patches can be keyed by it.
+
+    """
+    conn.execute("CREATE TABLE IF NOT EXISTS patch_data_version (version INTEGER NOT NULL)")
+
+    if conn.execute("SELECT count(*) FROM patch_data_version").scalar() == 0:
+        conn.execute("INSERT INTO patch_data_version (version) VALUES (0)")
+
+    for name, event in (
+            ('patch_data_version_insert', 'INSERT'),
+            ('patch_data_version_update', 'UPDATE OF data'),
+            ('patch_data_version_delete', 'DELETE')):
+        conn.execute("CREATE TRIGGER IF NOT EXISTS %s AFTER %s ON patch BEGIN "
+                     "UPDATE patch_data_version SET version = version + 1; END" % (name, event))
+
+
+@migration(6)
+def add_duplicate_clusters(conn):
+    """Add trigger removing deleted patches from clusters of near-duplicates.
+
+    The duplicate_cluster and duplicate_member tables are created by ``create_all``.
+
+    """
+    conn.execute("CREATE TRIGGER IF NOT EXISTS duplicate_member_delete AFTER DELETE ON patch "
+                 "BEGIN DELETE FROM duplicate_member WHERE patch_id = old.id; END")
@@ -8,40 +8,113 @@
 __all__ = (
     'Author',
     'Device',
+    'DuplicateCluster',
+    'DuplicateMember',
     'HexByteString',
     'Manufacturer',
     'Patch',
+    'SourceFile',
     'Tag',
+    'VoiceParams',
     'configure_session',
+    'fts_query',
+    'get_existing_hashes',
+    'get_data_version',
     'get_or_create',
+    'get_patch_ids',
     'initdb',
+    'load_patch_data',
+    'parse_pragmas',
+    'patch_data_version',
+    'patch_fts',
 )
 
 import datetime
 import logging
+from functools import partial
 
-from sqlalchemy import (Column, DateTime, ForeignKey, Integer, LargeBinary, Sequence, String,
-                        Table, TypeDecorator, Unicode, create_engine)
+from sqlalchemy import (Boolean, Column, DateTime, Float, ForeignKey, Index, Integer, LargeBinary,
+                        Sequence, SmallInteger, String, Table, TypeDecorator, Unicode, bindparam,
+                        column, create_engine, event, select, table)
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import backref, relationship, sessionmaker
+from sqlalchemy.orm import backref, deferred, relationship, sessionmaker
 from sqlalchemy.orm.exc import NoResultFound
 
-from .util import ellip
+from .codec import PARAMS, decode, voice_hash
+from .migrations import upgrade
+from .util import ellip, get_voice_hash
 
 
 log = logging.getLogger(__name__)
 Base = declarative_base()
 Session = sessionmaker(autocommit=True)
 DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+# SQLite limits the number of host parameters in a single statement
+MAX_IN_PARAMS = 500
+# Performance settings applied to every new SQLite connection via PRAGMA statements.
+# WAL journaling lets readers proceed while another connection writes and, together with
+# synchronous=NORMAL, needs far fewer fsync calls per transaction than the default rollback
+# journal. A negative cache_size is in KiB.
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -32768,
+    'mmap_size': 268435456,
+    'temp_store': 'MEMORY',
+}
 
 
-def configure_session(db_uri, sessionmaker=Session, debug=False):
+def _set_sqlite_pragmas(pragmas, dbapi_conn, connection_record):
+    cursor = dbapi_conn.cursor()
+
+    for name, value in pragmas.items():
+        log.debug("Setting SQLite PRAGMA %s = %s", name, value)
+        cursor.execute("PRAGMA %s = %s" % (name, value))
+
+    cursor.close()
+
+
+def configure_session(db_uri, sessionmaker=Session, debug=False, pragmas=None, readonly=False):
+    """Create database engine for given URI and bind sessionmaker to it.
+
+    For SQLite databases, the settings in ``SQLITE_PRAGMAS``, updated with the optional
+    ``pragmas`` dictionary, are applied to each new connection. Settings with a value of
+    ``None`` are not applied. With ``readonly=True``, connections do not change the journal
+    mode and refuse all writes, so any number of readers can use a shared database file.
+
+    """
     engine = create_engine(db_uri, echo=debug)
+
+    if engine.dialect.name == 'sqlite':
+        settings = dict(SQLITE_PRAGMAS, **(pragmas or {}))
+
+        if readonly:
+            settings.pop('journal_mode', None)
+            settings['query_only'] = 'ON'
+
+        settings = {name: value for name, value in settings.items() if value is not None}
+        event.listen(engine, 'connect', partial(_set_sqlite_pragmas, settings))
+
     sessionmaker.configure(bind=engine)
     return sessionmaker()
 
 
+def parse_pragmas(specs):
+    """Parse a list of 'NAME=VALUE' strings, e.g. from command line options, into a dict."""
+    pragmas = {}
+
+    for spec in specs or ():
+        name, sep, value = spec.partition('=')
+
+        if not sep or not name.strip().isidentifier():
+            raise ValueError("Invalid PRAGMA setting: %r" % spec)
+
+        pragmas[name.strip().lower()] = value.strip() or None
+
+    return pragmas
+
+
 def get_or_create(session, model, create_method=None, create_kwargs=None, **kwargs):
     try:
         return session.query(model).filter_by(**kwargs).one(), True
@@ -58,19 +131,72 @@ def get_or_create(session, model, create_method=None, create_kwargs=None, **kwar
             return session.query(model).filter_by(**kwargs).one(), True
 
 
-def initdb(db_uri=None, session=None, drop_all=False, debug=False):
-    """Create all tables in the database."""
+def initdb(db_uri=None, session=None, drop_all=False, debug=False, pragmas=None, readonly=False):
+    """Create all tables in the database and migrate it to the current schema version.
+
+    Read-only databases are neither created nor migrated.
+
+    """
     if not session:
-        session = configure_session(db_uri, debug=debug)
+        session = configure_session(db_uri, debug=debug, pragmas=pragmas, readonly=readonly)
+
+    if readonly:
+        return session
 
     with session.begin():
         if drop_all:
             Base.metadata.drop_all(bind=session.get_bind())
         Base.metadata.create_all(bind=session.get_bind(), checkfirst=True)
+        upgrade(session.connection())
 
     return session
 
 
+def get_existing_hashes(session, hashes):
+    """Return the set of given voice hashes, which are already present in the patch table.
+
+    This uses only SQL expressions and no ORM objects, so it's cheap to call with a large number
+    of hashes.
+
+    """
+    return set(get_patch_ids(session, hashes))
+
+
+def get_patch_ids(session, hashes):
+    """Return dict mapping those of given voice hashes present in the patch table to patch ids."""
+    table = Patch.__table__
+    # an expanding parameter is compiled once instead of once per value
+    query = select([table.c.hash, table.c.id]).where(
+        table.c.hash.in_(bindparam('hashes', expanding=True)))
+    hashes = list(hashes)
+    found = {}
+
+    for i in range(0, len(hashes), MAX_IN_PARAMS):
+        found.update(session.execute(query, {'hashes': hashes[i:i + MAX_IN_PARAMS]}).fetchall())
+
+    return found
+
+
+def load_patch_data(session, ids, extra=()):
+    """Fetch voice data for the patches with given ids.
+
+    Returns a list of ``(id, data)`` tuples in the order of the given ids. The values of the
+    patch table columns named in ``extra`` are appended to each tuple. The data is fetched with
+    one query per ``MAX_IN_PARAMS`` ids, without creating ORM objects.
+
+    """
+    table = Patch.__table__
+    columns = [table.c.id, table.c.data] + [table.c[name] for name in extra]
+    ids = list(ids)
+    rows = {}
+
+    for i in range(0, len(ids), MAX_IN_PARAMS):
+        query = select(columns).where(table.c.id.in_(ids[i:i + MAX_IN_PARAMS]))
+        rows.update((row[0], tuple(row)) for row in session.execute(query))
+
+    return [rows[id_] for id_ in ids if id_ in rows]
+
+
 class HexByteString(TypeDecorator):
     """Convert Python bytestring to string with hexadecimal digits and back for storage."""
 
@@ -107,32 +233,69 @@ patch_tag = Table(
     'patch_tag',
     Base.metadata,
     Column('patch_id', Integer, ForeignKey('patch.id')),
-    Column('tag_id', Integer, ForeignKey('tag.id'))
+    Column('tag_id', Integer, ForeignKey('tag.id')),
+    Index('ix_patch_tag', 'patch_id', 'tag_id', unique=True),
+    Index('ix_patch_tag_tag_id', 'tag_id')
 )
 
 
+# Full-text search index of patches (FTS5 virtual table created by a migration).
+# The hidden 'rank' column holds the BM25 relevance of a match, lower is better.
+patch_fts = table('patch_fts', column('rowid'), column('rank'))
+
+
+# Single row table with a counter of changes to patch data (created by a migration).
+patch_data_version = table('patch_data_version', column('version'))
+
+
+def get_data_version(session):
+    """Return the current patch data version.
+
+    The version is incremented whenever a patch is added or deleted or its voice data changes.
+
+    """
+    return session.execute(select([patch_data_version.c.version])).scalar()
+
+
+def fts_query(text, min_length=2):
+    """Convert search box text into an FTS5 query matching all words as prefixes.
+
+    Words shorter than ``min_length`` are ignored, since they would match most of the library
+    and are not covered by the prefix indexes. Returns None if the text contains no words.
+
+    """
+    words = ''.join(c if c.isalnum() else ' ' for c in text).split()
+    return ' '.join('"%s"*' % word for word in words if len(word) >= min_length) or None
+
+
 class Patch(Base):
     """Definition of patch table."""
 
     __tablename__ = 'patch'
     id = Column(Integer, Sequence('patch_id_seq'), primary_key=True)
-    name = Column(Unicode(10), nullable=False)
-    displayname = Column(Unicode(50), nullable=False)
+    name = Column(Unicode(10), nullable=False, index=True)
+    displayname = Column(Unicode(50), nullable=False, index=True)
     description = Column(Unicode(150))
-    rating = Column(Integer)
+    rating = Column(Integer, index=True)
     tags = relationship('Tag', secondary=patch_tag, backref='patches')
     manufacturer_id = Column(Integer, ForeignKey('manufacturer.id'))
     manufacturer = relationship("Manufacturer", backref=backref('patches', order_by=id))
     device_id = Column(Integer, ForeignKey('device.id'))
     device = relationship("Device", backref=backref('patches', order_by=id))
     # patch data (e.g. SysEx or other MIDI data)
-    data = Column(LargeBinary, nullable=False)
+    # Not loaded with the other columns, use load_patch_data or undefer('data') to fetch it.
+    data = deferred(Column(LargeBinary, nullable=False))
+    # hash of voice data payload, used to detect duplicates
+    hash = Column(String(40), unique=True, index=True)
 
     # meta data
-    created = Column(DateTime, default=datetime.datetime.now)
+    created = Column(DateTime, default=datetime.datetime.now, index=True)
     revision = Column(Integer, default=0)
-    author_id = Column(Integer, ForeignKey('author.id'))
+    author_id = Column(Integer, ForeignKey('author.id'), index=True)
     author = relationship("Author", backref=backref('patches', order_by=id))
+    # decoded voice parameters, rows are deleted by a trigger when the patch is deleted
+    params = relationship('VoiceParams', uselist=False, backref='patch',
+                          cascade='all, delete-orphan', passive_deletes=True)
 
     def __repr__(self):
         return "<Patch(%r (#%i), %r rev=%i (%s)>" % (
@@ -155,6 +318,105 @@ class Patch(Base):
             self.tags.append(tag)
 
 
+# Decoded voice parameters of each patch, one column per parameter (see
+# codec.PARAMS), so patches can be queried by their sound settings in SQL.
+voice_params = Table(
+    'voice_params',
+    Base.metadata,
+    Column('patch_id', Integer, ForeignKey('patch.id'), primary_key=True),
+    *(Column(name, Boolean if type_ is bool else SmallInteger, nullable=False, doc=description)
+      for name, _, _, type_, description in PARAMS),
+    Index('ix_voice_params_part_mode', 'part_mode'),
+    Index('ix_voice_params_algorithm', 'algorithm'),
+    Index('ix_voice_params_lfo_wave', 'lfo_wave'),
+    Index('ix_voice_params_effect_1_type', 'effect_1_type'),
+    Index('ix_voice_params_effect_2_type', 'effect_2_type')
+)
+
+
+class VoiceParams(Base):
+    """Decoded voice parameters of a patch."""
+
+    __table__ = voice_params
+
+    def __repr__(self):
+        return "<VoiceParams(patch #%i)>" % self.patch_id
+
+    def update(self, params):
+        for name, value in params.items():
+            setattr(self, name, value)
+
+
+@event.listens_for(Patch.data, 'set')
+def _update_voice_data(target, value, oldvalue, initiator):
+    try:
+        voice = decode(value)
+    except ValueError:
+        target.hash = get_voice_hash(value)
+        target.params = None
+        return
+
+    target.hash = voice_hash(value)
+
+    if target.params is None:
+        target.params = VoiceParams(**voice.params())
+    else:
+        target.params.update(voice.params())
+
+
+class DuplicateCluster(Base):
+    """Definition of table of groups of near-duplicate patches (see ``clustering``)."""
+
+    __tablename__ = 'duplicate_cluster'
+    id = Column(Integer, Sequence('duplicate_cluster_id_seq'), primary_key=True)
+    # maximum number of differing voice parameters used to find the cluster
+    max_diff = Column(Integer, nullable=False)
+    created = Column(DateTime, default=datetime.datetime.now)
+    members = relationship('DuplicateMember', backref='cluster', cascade='all, delete-orphan',
+                           order_by='(DuplicateMember.diff, DuplicateMember.patch_id)')
+
+    def __repr__(self):
+        return "<DuplicateCluster(#%i, %i member(s))>" % (self.id, len(self.members))
+
+
+class DuplicateMember(Base):
+    """Definition of table of patches belonging to a cluster of near-duplicates.
+
+    Rows are deleted by a trigger when the patch is deleted.
+
+    """
+
+    __tablename__ = 'duplicate_member'
+    patch_id = Column(Integer, ForeignKey('patch.id'), primary_key=True)
+    cluster_id = Column(Integer, ForeignKey('duplicate_cluster.id'), nullable=False, index=True)
+    # number of voice parameters differing from the first patch of the cluster
+    diff = Column(Integer, nullable=False)
+    patch = relationship('Patch')
+
+    def __repr__(self):
+        return "<DuplicateMember(patch #%i, cluster #%i, diff=%i)>" % (
+            self.patch_id, self.cluster_id, self.diff)
+
+
+class SourceFile(Base):
+    """Definition of table of files imported from watched folders (see ``sync``)."""
+
+    __tablename__ = 'source_file'
+    id = Column(Integer, Sequence('source_file_id_seq'), primary_key=True)
+    # absolute path
+    path = Column(Unicode, nullable=False, unique=True)
+    size = Column(Integer, nullable=False)
+    mtime = Column(Float, nullable=False)
+    # SHA-1 hex digest of file content
+    hash = Column(String(40), nullable=False)
+    # number of valid voices found in the file
+    voices = Column(Integer, nullable=False, default=0)
+    imported = Column(DateTime, default=datetime.datetime.now)
+
+    def __repr__(self):
+        return "<SourceFile(%r, %i voice(s))>" % (self.path, self.voices)
+
+
 class Manufacturer(Base):
     """Definition of manufacturer table."""
 
@@ -198,7 +460,7 @@ class Author(Base):
 
     __tablename__ = 'author'
     id = Column(Integer, Sequence('author_id_seq'), primary_key=True)
-    name = Column(Unicode(50), nullable=False)
+    name = Column(Unicode(50), nullable=False, index=True)
     displayname = Column(Unicode(150))
 
     def __repr__(self):
@@ -212,8 +474,6 @@ class Author(Base):
 
 
 if __name__ == '__main__':
-    from functools import partial
-
     def create_test_data(session):
 
         with session.begin():
@@ -237,11 +497,17 @@ if __name__ == '__main__':
 
             p = partial(Patch, author=a1, manufacturer=m1, device=d1)
 
-            p1 = p(name='PizzaToGo', displayname='PizzaToGo', data=b'\xF0\x43\0\xF7', tags=[t1, t2],
+            def data(name):
+                # dummy voice common block, voices need distinct payloads
+                return b'\xF0\x43\0\x7F\x1C\0\x2A\x05\x30\0\0' + name.encode() + b'\0\xF7'
+
+            p1 = p(name='PizzaToGo', displayname='PizzaToGo', data=data('PizzaToGo'),
+                   tags=[t1, t2],
                    description="A soft pizzicato sound ideal for percussive comping parts")
-            p2 = p(name='Liquid Lead', displayname='Liquid Lead', data=b'\xF0\x43\0\xF7', tags=[t1])
-            p3 = p(name='SunrizPad', displayname='SunrizPad', data=b'\xF0\x43\0\xF7', tags=[t3])
-            p4 = p(name='Bell Pad', displayname='Bell Pad', data=b'\xF0\x43\0\xF7', tags=[t3])
+            p2 = p(name='Liquid Lead', displayname='Liquid Lead', data=data('Liquid Lead'),
+                   tags=[t1])
+            p3 = p(name='SunrizPad', displayname='SunrizPad', data=data('SunrizPad'), tags=[t3])
+            p4 = p(name='Bell Pad', displayname='Bell Pad', data=data('Bell Pad'), tags=[t3])
             session.add(p1)
             session.add(p2)
             session.add(p3)
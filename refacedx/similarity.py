@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+#
+# refacedx/similarity.py
+"""Find patches with similar voice parameters.
+
+Each voice is turned into a feature vector, in which every parameter is normalized to 0..1
+using its value range from ``voiceparams``. Parameters whose values are choices rather than
+amounts (algorithm, waveforms, effect types, curves, etc.) are one-hot encoded, so any two
+different choices are equally far apart. Each feature is scaled by the square root of the
+weight of its parameter group (see ``DEFAULT_WEIGHTS``), so the squared euclidean distance of
+two vectors is the weighted sum of the squared parameter differences.
+
+The feature matrix of the whole library is kept in memory as ``float32`` and a query is a
+single matrix-vector product, which takes a few milliseconds for 100k patches.
+
+This module needs NumPy (see ``analysis``).
+
+"""
+
+import logging
+
+import numpy as np
+
+from .analysis import load_voice_array
+from .codec import PARAMS
+from .model import get_data_version
+from .voiceparams import params_common, params_op
+
+
+__all__ = ('DEFAULT_WEIGHTS', 'SimilarityIndex', 'find_similar', 'get_param_group')
+
+log = logging.getLogger(__name__)
+DEFAULT_WEIGHTS = {
+    'algorithm': 8.0,
+    'level': 4.0,
+    'ratio': 4.0,
+    'envelope': 1.0,
+    'other': 0.5,
+}
+# parameters which select one of several options, in addition to those with named values
+CATEGORICAL_PARAMS = ('algorithm',)
+_index_cache = {}
+
+
+def _get_param_specs():
+    """Return list of (name, range, categorical) for all params in codec.PARAMS order."""
+    specs = {}
+
+    for _, _, type_, name, range_, mapping, _ in params_common + params_op:
+        if type_ in (int, bool):
+            categorical = (name in CATEGORICAL_PARAMS or
+                           (isinstance(mapping, tuple) and isinstance(mapping[0], (str, tuple))))
+            specs[name] = (range_, categorical)
+
+    return [(name,) + specs[name if part == 1 else 'op' + name[3:]]
+            for name, part, _, _, _ in PARAMS]
+
+
+PARAM_SPECS = _get_param_specs()
+
+
+def get_param_group(name):
+    """Return weight group of voice parameter with given name (see ``DEFAULT_WEIGHTS``)."""
+    if name.startswith('op') and name[2:3].isdigit():
+        name = 'op' + name[3:]
+
+    if name == 'algorithm':
+        return 'algorithm'
+    elif name == 'op_level':
+        return 'level'
+    elif name.startswith('op_freq_') and name != 'op_freq_detunes':
+        return 'ratio'
+    elif '_eg_rate_' in name or '_eg_level_' in name:
+        return 'envelope'
+    else:
+        return 'other'
+
+
+def build_features(voices, weights=None):
+    """Return weighted, normalized feature matrix for structured array of voices.
+
+    ``voices`` is an array with ``analysis.VOICE_DTYPE``. ``weights`` may map parameter groups
+    to weights, overriding ``DEFAULT_WEIGHTS``.
+
+    """
+    weights = dict(DEFAULT_WEIGHTS, **(weights or {}))
+    columns = []
+
+    for name, (low, high), categorical in PARAM_SPECS:
+        scale = np.sqrt(weights[get_param_group(name)])
+
+        if not scale:
+            continue
+
+        values = voices[name].astype(np.float32)
+
+        if categorical:
+            # two different choices differ in two columns, hence the factor 1/sqrt(2)
+            onehot = values[:, None] == np.arange(low, high + 1, dtype=np.float32)
+            columns.append(onehot * np.float32(scale / np.sqrt(2)))
+        else:
+            normalized = np.clip((values - low) / (high - low), 0, 1)
+            columns.append((normalized * np.float32(scale))[:, None])
+
+    if not columns:
+        return np.zeros((len(voices), 0), dtype=np.float32)
+
+    return np.hstack(columns).astype(np.float32, copy=False)
+
+
+class SimilarityIndex:
+    """Nearest-neighbour search over the voice parameters of a set of patches."""
+
+    def __init__(self, voices, weights=None, data_version=None):
+        order = np.argsort(voices['patch_id'], kind='stable')
+        self.ids = voices['patch_id'][order]
+        self.features = build_features(voices[order], weights)
+        self.sq_norms = np.einsum('ij,ij->i', self.features, self.features)
+        self.weights = weights
+        self.data_version = data_version
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def from_session(cls, session, weights=None, cache_dir=None):
+        """Build index over all patches in the database of given session."""
+        version = get_data_version(session)
+        return cls(load_voice_array(session, cache_dir=cache_dir), weights, version)
+
+    def get_row(self, patch_id):
+        """Return row index of patch with given id or raise KeyError."""
+        row = np.searchsorted(self.ids, patch_id)
+
+        if row >= len(self.ids) or self.ids[row] != patch_id:
+            raise KeyError(patch_id)
+
+        return row
+
+    def similar(self, patch_id, count=10):
+        """Return list of (patch id, distance) of the patches most similar to the given one.
+
+        The patch itself is not included. Raises KeyError if the patch is not in the index.
+
+        """
+        row = self.get_row(patch_id)
+        return [(id_, dist) for id_, dist in self.query(self.features[row], count + 1)
+                if id_ != patch_id][:count]
+
+    def query(self, vector, count=10):
+        """Return list of (patch id, distance) of patches nearest to given feature vector."""
+        count = min(count, len(self.ids))
+
+        if not count:
+            return []
+
+        dists = self.sq_norms - 2 * (self.features @ vector) + vector @ vector
+        nearest = np.argpartition(dists, count - 1)[:count]
+        nearest = nearest[np.argsort(dists[nearest], kind='stable')]
+        return [(int(self.ids[i]), float(np.sqrt(max(dists[i], 0)))) for i in nearest]
+
+
+def find_similar(session, patch_id, count=10, weights=None):
+    """Return ids of the ``count`` patches most similar to patch with given id, best first.
+
+    The index is built on first use and rebuilt when patches have been added, changed or
+    deleted. Raises KeyError if there is no patch with valid voice data with given id.
+
+    """
+    key = (str(session.get_bind().url), tuple(sorted((weights or {}).items())))
+    index = _index_cache.get(key)
+
+    if index is None or index.data_version != get_data_version(session):
+        index = _index_cache[key] = SimilarityIndex.from_session(session, weights)
+        log.debug("Built similarity index over %i patch(es).", len(index))
+
+    return [id_ for id_, _ in index.similar(patch_id, count)]
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+#
+# refacedx/sync.py
+"""Incremental import of SysEx files from watched folders.
+
+For every file imported by ``sync_files``, its absolute path, size, modification time and a
+SHA-1 hash of its content are recorded in the ``source_file`` table. On the next sync, files with
+the same size and modification time as recorded are skipped without opening them. Files whose
+size or modification time changed are hashed and only imported again if their content changed,
+otherwise just their record is updated. Files, which could not be read, are not recorded, so they
+are tried again on the next sync.
+
+Records of files, which were removed from a watched folder, are deleted by ``prune_files``. The
+patches imported from them stay in the library.
+
+"""
+
+import hashlib
+import logging
+from os import sep, stat
+from os.path import abspath, dirname, isdir
+
+from sqlalchemy import bindparam, delete, select
+
+from .importer import find_files, map_file
+from .model import MAX_IN_PARAMS, SourceFile
+
+
+__all__ = ('get_source_files', 'hash_file', 'prune_files', 'sync_files', 'sync_folders')
+
+log = logging.getLogger(__name__)
+
+
+def hash_file(filename):
+    """Return SHA-1 hex digest of the content of given file."""
+    with map_file(filename) as data:
+        return hashlib.sha1(data).hexdigest()
+
+
+def get_source_files(session, paths):
+    """Return dict mapping those of given absolute paths, which have a record, to their record.
+
+    Records are ``(id, size, mtime, hash, voices)`` tuples.
+
+    """
+    table = SourceFile.__table__
+    query = select([table.c.path, table.c.id, table.c.size, table.c.mtime, table.c.hash,
+                    table.c.voices]).where(table.c.path.in_(bindparam('paths', expanding=True)))
+    paths = list(paths)
+    found = {}
+
+    for i in range(0, len(paths), MAX_IN_PARAMS):
+        for path, *record in session.execute(query, {'paths': paths[i:i + MAX_IN_PARAMS]}):
+            found[path] = tuple(record)
+
+    return found
+
+
+def _record_files(session, rows):
+    """Insert or replace records for given row dictionaries in the source file table."""
+    table = SourceFile.__table__
+
+    with session.begin():
+        for i in range(0, len(rows), MAX_IN_PARAMS):
+            paths = [row['path'] for row in rows[i:i + MAX_IN_PARAMS]]
+            session.execute(delete(table).where(table.c.path.in_(paths)))
+
+        if rows:
+            session.execute(table.insert(), rows)
+
+
+def sync_files(session, files, importer, progress=None, error=None, cancel=None):
+    """Import those of given SysEx files, which are new or changed since they were last synced.
+
+    ``importer`` is a ``PatchImporter`` instance and ``progress``, ``error`` and ``cancel`` are
+    passed to its ``import_files`` method. Returns its ``ImportStats`` instance, with the number
+    of files skipped, because they did not change, in the ``unchanged`` attribute.
+
+    """
+    paths = list(dict.fromkeys(abspath(filename) for filename in files))
+    records = get_source_files(session, paths)
+    pending = {}
+    touched = []
+    unchanged = 0
+
+    for path in paths:
+        if cancel is not None and cancel.is_set():
+            break
+
+        try:
+            st = stat(path)
+            record = records.get(path)
+
+            if record and record[1:3] == (st.st_size, st.st_mtime):
+                unchanged += 1
+                continue
+
+            hash_ = hash_file(path)
+        except OSError as exc:
+            # let the importer report files, which can not be read
+            log.debug("Could not hash file '%s': %s", path, exc)
+            pending[path] = None
+            continue
+
+        row = dict(path=path, size=st.st_size, mtime=st.st_mtime, hash=hash_)
+
+        if record and record[3] == hash_:
+            log.debug("File '%s' was touched, but did not change.", path)
+            row['voices'] = record[4]
+            touched.append(row)
+            unchanged += 1
+        else:
+            pending[path] = row
+
+    log.debug("Sync: %i new or changed and %i unchanged file(s).", len(pending), unchanged)
+    imported = []
+
+    def done(path, voices):
+        row = pending[path]
+
+        if row is not None:
+            row['voices'] = voices
+            imported.append(row)
+
+    stats = importer.import_files(list(pending), progress=progress, error=error, cancel=cancel,
+                                  done=done)
+
+    _record_files(session, imported + touched)
+    stats.unchanged = unchanged
+    stats.cancelled = stats.cancelled or (cancel is not None and cancel.is_set())
+    return stats
+
+
+def prune_files(session, folders, files, recursive=True):
+    """Delete records of files in given folders, which are not in the given list of files.
+
+    Returns the number of deleted records.
+
+    """
+    table = SourceFile.__table__
+    existing = set(abspath(filename) for filename in files)
+    stale = []
+
+    for folder in folders:
+        folder = abspath(folder)
+        prefix = folder.rstrip(sep) + sep
+        query = select([table.c.id, table.c.path]).where(
+            table.c.path.startswith(prefix, autoescape=True))
+
+        for id_, path in session.execute(query).fetchall():
+            # LIKE is case-insensitive in SQLite
+            if not path.startswith(prefix) or path in existing:
+                continue
+
+            if recursive or dirname(path) == folder:
+                stale.append(id_)
+
+    if stale:
+        with session.begin():
+            for i in range(0, len(stale), MAX_IN_PARAMS):
+                session.execute(delete(table).where(table.c.id.in_(stale[i:i + MAX_IN_PARAMS])))
+
+        log.info("Removed records of %i file(s) no longer present.", len(stale))
+
+    return len(stale)
+
+
+def sync_folders(session, folders, importer, recursive=True, progress=None, error=None,
+                 cancel=None):
+    """Import new and changed SysEx files from given folders (see ``sync_files``).
+
+    Records of files no longer present in the folders are removed, unless the sync was cancelled.
+    Folders, which do not exist, are skipped with a warning.
+
+    """
+    existing = []
+
+    for folder in folders:
+        if isdir(folder):
+            existing.append(folder)
+        else:
+            log.warning("Watched folder '%s' does not exist.", folder)
+
+    files = list(find_files(existing, recursive))
+    stats = sync_files(session, files, importer, progress, error, cancel)
+
+    if not stats.cancelled:
+        prune_files(session, existing, files, recursive)
+
+    return stats
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# refacedx/tools/find_duplicates.py
+#
+"""Find, list and merge clusters of near-duplicate patches in a patch library database."""
+
+import argparse
+import logging
+import sys
+
+from ..model import initdb, parse_pragmas
+
+
+log = logging.getLogger(__name__)
+
+
+def print_clusters(clusters):
+    for cluster in clusters:
+        print("Cluster #%i (%i patches):" % (cluster.id, len(cluster.members)))
+
+        for member in cluster.members:
+            patch = member.patch
+            print("  #%-6i %-20s %s" % (
+                patch.id, patch.displayname,
+                "(%i parameter(s) differ)" % member.diff if member.diff else ""))
+
+
+def main(args=None):
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument(
+        "-d",
+        "--database",
+        metavar="PATH",
+        default="refacedx.db",
+        help="Path of patch library database file (default: '%(default)s').",
+    )
+    ap.add_argument(
+        "-k",
+        "--keep",
+        type=int,
+        metavar="PATCH",
+        help="ID of patch to keep when merging a cluster (default: the first patch).",
+    )
+    ap.add_argument(
+        "-l",
+        "--list",
+        action="store_true",
+        help="List the stored clusters instead of searching the library again.",
+    )
+    ap.add_argument(
+        "-m",
+        "--merge",
+        type=int,
+        metavar="CLUSTER",
+        action="append",
+        help="Merge the patches of the stored cluster with given ID into one patch and delete "
+        "the others. May be given more than once.",
+    )
+    ap.add_argument(
+        "-n",
+        "--max-diff",
+        type=int,
+        default=1,
+        metavar="NUM",
+        help="Maximum number of differing voice parameters of near-duplicates "
+        "(default: %(default)s).",
+    )
+    ap.add_argument(
+        "-p",
+        "--pragma",
+        metavar="NAME=VALUE",
+        action="append",
+        help="Set SQLite PRAGMA for the database connection, overriding the default "
+        "performance settings. May be given more than once.",
+    )
+    ap.add_argument(
+        "-q",
+        "--quiet",
+        action="store_true",
+        help="Do not print messages except errors.",
+    )
+    ap.add_argument("-v", "--debug", action="store_true", help="Enable debug logging.")
+
+    args = ap.parse_args(args if args is not None else sys.argv[1:])
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.WARN if args.quiet else logging.INFO,
+        format="%(levelname)s - %(message)s",
+    )
+
+    if args.max_diff < 0:
+        ap.error("--max-diff must not be negative.")
+
+    if args.keep is not None and len(args.merge or ()) != 1:
+        ap.error("--keep can only be used when merging a single cluster.")
+
+    try:
+        pragmas = parse_pragmas(args.pragma)
+    except ValueError as exc:
+        ap.error(str(exc))
+
+    try:
+        from ..clustering import get_clusters, merge_cluster, update_clusters
+    except ImportError as exc:
+        log.error("Finding near-duplicates requires NumPy: %s", exc)
+        return 1
+
+    session = initdb('sqlite:///{}'.format(args.database), pragmas=pragmas)
+
+    if args.merge:
+        for cluster_id in args.merge:
+            try:
+                merge_cluster(session, cluster_id, args.keep)
+            except ValueError as exc:
+                log.error(str(exc))
+                return 1
+    else:
+        if not args.list:
+            update_clusters(session, args.max_diff)
+
+        if not args.quiet:
+            print_clusters(get_clusters(session))
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]) or 0)
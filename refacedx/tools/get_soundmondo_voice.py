@@ -21,6 +21,8 @@ import requests
 import rtmidi
 from rtmidi.midiutil import list_output_ports, open_midioutput
 
+from refacedx.util import iter_sysex
+
 try:
     import cachecontrol
     from cachecontrol.caches.file_cache import FileCache
@@ -197,35 +199,15 @@ def send_sysex_file(filename, midiout, portname, delay=50):
     with open(filename, "rb") as sysex_file:
         data = sysex_file.read()
 
-        if data.startswith(SYSTEM_EXCLUSIVE):
-            sox = 0
-            i = 0
-
-            log.info("Sending SysEx file '%s' data to '%s'.", filename, portname)
-            while sox >= 0:
-                sox = data.find(SYSTEM_EXCLUSIVE, sox)
-
-                if sox >= 0:
-                    eox = data.find(END_OF_EXCLUSIVE, sox)
-
-                    if eox >= 0:
-                        sysex_msg = data[sox:eox + 1]
-                        # Python 2: convert data into list of integers
-                        if isinstance(sysex_msg, str):
-                            sysex_msg = [ord(c) for c in sysex_msg]
-
-                        log.debug("Sending '%s' message #%03i...", bn, i)
-                        midiout.send_message(sysex_msg)
-                        time.sleep(0.001 * delay)
-
-                        i += 1
-                    else:
-                        break
-
-                    sox = eox + 1
-        else:
-            log.warning("File '%s' does not start with a SysEx message.", bn)
+    if data.startswith(SYSTEM_EXCLUSIVE):
+        log.info("Sending SysEx file '%s' data to '%s'.", filename, portname)
 
+        for i, sysex_msg in enumerate(iter_sysex(data)):
+            log.debug("Sending '%s' message #%03i...", bn, i)
+            midiout.send_message(sysex_msg)
+            time.sleep(0.001 * delay)
+    else:
+        log.warning("File '%s' does not start with a SysEx message.", bn)
 
 
 def write_sysex_to_file(fobj, messages):
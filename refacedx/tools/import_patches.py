@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# refacedx/tools/import_patches.py
+#
+"""Import Reface DX voice SysEx files into a patch library database."""
+
+import argparse
+import logging
+import sys
+from os.path import isdir
+
+from ..importer import PatchImporter, find_files
+from ..model import initdb, parse_pragmas
+from ..sync import prune_files, sync_files
+
+
+log = logging.getLogger(__name__)
+
+
+def main(args=None):
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument(
+        "-b",
+        "--batch-size",
+        type=int,
+        default=500,
+        help="Number of patches to write to the database per transaction "
+        "(default: %(default)s).",
+    )
+    ap.add_argument(
+        "-d",
+        "--database",
+        metavar="PATH",
+        default="refacedx.db",
+        help="Path of patch library database file (default: '%(default)s').",
+    )
+    ap.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=0,
+        metavar="NUM",
+        help="Number of worker processes reading, validating and decoding files "
+        "(default: number of CPUs, 1 reads all files in the main process).",
+    )
+    ap.add_argument(
+        "-p",
+        "--pragma",
+        metavar="NAME=VALUE",
+        action="append",
+        help="Set SQLite PRAGMA for the database connection, overriding the default "
+        "performance settings, e.g. 'synchronous=OFF'. May be given more than once. "
+        "An empty value disables a default setting.",
+    )
+    ap.add_argument(
+        "-q",
+        "--quiet",
+        action="store_true",
+        help="Do not print messages except errors.",
+    )
+    ap.add_argument(
+        "-r",
+        "--recursive",
+        action="store_true",
+        help="Search given directories recursively for SysEx files.",
+    )
+    ap.add_argument(
+        "-s",
+        "--sync",
+        action="store_true",
+        help="Only import files, which are new or changed since they were last imported with "
+        "this option, and remember the imported files.",
+    )
+    ap.add_argument("-v", "--debug", action="store_true", help="Enable debug logging.")
+    ap.add_argument(
+        "paths",
+        nargs="+",
+        metavar="PATH",
+        help="SysEx file, zip or tar archive, or directory containing SysEx files (*.syx) and "
+        "archives to import.",
+    )
+
+    args = ap.parse_args(args if args is not None else sys.argv[1:])
+    logging.basicConfig(
+        level=logging.DEBUG if args.debug else logging.WARN if args.quiet else logging.INFO,
+        format="%(levelname)s - %(message)s",
+    )
+
+    try:
+        pragmas = parse_pragmas(args.pragma)
+    except ValueError as exc:
+        ap.error(str(exc))
+
+    session = initdb('sqlite:///{}'.format(args.database), pragmas=pragmas)
+    importer = PatchImporter(session, args.batch_size, workers=args.jobs)
+
+    if args.sync:
+        files = list(find_files(args.paths, args.recursive))
+        stats = sync_files(session, files, importer)
+        log.info("Skipped %i unchanged file(s).", stats.unchanged)
+        prune_files(session, [path for path in args.paths if isdir(path)], files, args.recursive)
+    else:
+        stats = importer.import_files(find_files(args.paths, args.recursive))
+
+    return 1 if stats.errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]) or 0)
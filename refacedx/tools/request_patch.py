@@ -16,6 +16,7 @@ from os.path import exists, splitext
 
 from rtmidi.midiutil import open_midiinput, open_midioutput
 
+from ..archiveio import is_archive, write_archive
 from ..midiio import RefaceDX, TimeoutError
 from ..util import get_patch_name
 
@@ -37,6 +38,8 @@ PATH_SUBST_KEYS = (
     "year",
 )
 DATE_KEYS = ("year", "month", "day", "hour", "minute", "second")
+DEFAULT_PATH = "{name}.syx"
+DEFAULT_BANK_PATH = "reface_dx_bank_{year:04}{month:02}{day:02}-{hour:02}{minute:02}{second:02}.syx"
 
 
 def sanitize_fn(fn, subst="_"):
@@ -57,8 +60,89 @@ def build_path(path, **data):
     return path.format(**subst)
 
 
+def get_slot(program):
+    """Return bank and slot number string, e.g. '2-3', for given program number (1..32)."""
+    return "{}-{}".format((program - 1) // 8 + 1, (program - 1) % 8 + 1)
+
+
+def request_bank(reface, programs, device=None, timeout=None, retries=2, delay=0.0):
+    """Request the patches with given program numbers (1..32) one after another.
+
+    Each program change and patch request is sent as soon as the previous patch is received
+    completely, after waiting ``delay`` seconds. The programs, which were not received within
+    ``timeout`` seconds, are requested again after all others, up to ``retries`` times.
+
+    Returns a dict mapping program numbers to patch data.
+
+    """
+    patches = {}
+    pending = list(programs)
+
+    for attempt in range(retries + 1):
+        failed = []
+        start = time.perf_counter()
+
+        for program in pending:
+            reface.send_program_change(program - 1)
+
+            if delay:
+                time.sleep(delay)
+
+            try:
+                patches[program] = reface.patch_request(device, timeout=timeout)
+            except TimeoutError:
+                log.warning("Did not receive patch %s (program %i) within timeout.",
+                            get_slot(program), program)
+                failed.append(program)
+            else:
+                log.info("Received patch %s '%s'.", get_slot(program),
+                         get_patch_name(patches[program]))
+
+        log.debug("Requested %i patch(es) in %.2f sec.", len(pending),
+                  time.perf_counter() - start)
+
+        if not failed:
+            break
+        elif attempt < retries:
+            log.info("Requesting %i failed patch(es) again...", len(failed))
+
+        pending = failed
+
+    corrupt = sum(reface.corrupt_blocks.values())
+    if corrupt:
+        log.warning("%i of %i block(s) received had a checksum error and were requested again.",
+                    corrupt, reface.received_blocks)
+
+    return patches
+
+
+def write_bank(patches, output_path):
+    """Write dict of patch data by program number to one bank SysEx file or archive."""
+    if is_archive(output_path):
+        log.info("Writing %i patch(es) to archive '%s'...", len(patches), output_path)
+        write_archive(output_path, (
+            ("{}_{}.syx".format(get_slot(program),
+                                sanitize_fn(get_patch_name(patches[program])).replace(" ", "_")),
+             patches[program])
+            for program in sorted(patches)))
+    else:
+        log.info("Writing %i patch(es) to bank file '%s'...", len(patches), output_path)
+
+        with open(output_path, "wb") as sysex:
+            for program in sorted(patches):
+                sysex.write(patches[program])
+
+
 def main(args=None):
     ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument(
+        "-b",
+        "--bank",
+        action="store_true",
+        help="Request all given programs (default: all 32) as fast as the device replies and "
+        "write them to one bank SysEx file or, if the output path ends with an archive "
+        "extension, e.g. '.zip', to an archive with one SysEx file per program.",
+    )
     ap.add_argument(
         "-c",
         "--channel",
@@ -99,8 +183,8 @@ def main(args=None):
         "-f",
         "--output-path",
         metavar="PATH",
-        default="{name}.syx",
-        help="Path of output file to write SysEx data to (default: '%(default)s')",
+        help="Path of output file to write SysEx data to (default: '%s', with --bank: '%s')" % (
+            DEFAULT_PATH, DEFAULT_BANK_PATH),
     )
     ap.add_argument(
         "-q",
@@ -114,6 +198,29 @@ def main(args=None):
         action="store_true",
         help="Replace existing output file(s) (default: no).",
     )
+    ap.add_argument(
+        "-t",
+        "--timeout",
+        type=float,
+        metavar="SEC",
+        help="Maximum timeout for receiving each part of a patch dump. The timeout adapts to "
+        "the measured latency of the device (default: 5.0, with --bank: 1.0).",
+    )
+    ap.add_argument(
+        "--delay",
+        type=float,
+        default=0.0,
+        metavar="SEC",
+        help="Time to wait after each program change with --bank (default: %(default)s).",
+    )
+    ap.add_argument(
+        "--retries",
+        type=int,
+        default=2,
+        metavar="NUM",
+        help="How often to request patches again, which were not received, with --bank "
+        "(default: %(default)s).",
+    )
     ap.add_argument(
         "patches",
         nargs="*",
@@ -135,7 +242,8 @@ def main(args=None):
         return 1
 
     channel = max(1, min(16, args.channel))
-    reface = RefaceDX(midiin, midiout, channel=channel - 1)
+    timeout = args.timeout or (1.0 if args.bank else 5.0)
+    reface = RefaceDX(midiin, midiout, channel=channel - 1, timeout=timeout)
 
     if args.patches:
         patches = set()
@@ -151,6 +259,33 @@ def main(args=None):
 
         args.patches = sorted(list(patches))
 
+    if args.bank:
+        now = datetime.now()
+        output_path = build_path(args.output_path or DEFAULT_BANK_PATH,
+                                 **{name: getattr(now, name) for name in DATE_KEYS})
+
+        if not splitext(output_path)[1]:
+            output_path += ".syx"
+
+        if exists(output_path) and not args.replace:
+            log.error("Existing output file '%s' will not be overwritten.", output_path)
+            return 1
+
+        programs = [program for program in args.patches or range(1, 33) if 32 >= program >= 1]
+        patches = request_bank(reface, programs, args.device, retries=args.retries,
+                               delay=args.delay)
+
+        if patches:
+            write_bank(patches, output_path)
+
+        missing = sorted(set(programs).difference(patches))
+
+        if missing:
+            log.error("Could not receive patch(es): %s", ", ".join(map(get_slot, missing)))
+            return 1
+
+        return
+
     for patchno in args.patches or [None]:
         if patchno is not None:
             if 32 >= patchno >= 1:
@@ -177,9 +312,9 @@ def main(args=None):
 
             if patchno is not None:
                 data["program"] = patchno
-                data["slot"] = "{}-{}".format((patchno - 1) // 8 + 1, (patchno - 1) % 8 + 1)
+                data["slot"] = get_slot(patchno)
 
-            output_path = build_path(args.output_path, **data)
+            output_path = build_path(args.output_path or DEFAULT_PATH, **data)
             log.info("Output path (after substitution): %s", output_path)
 
             if not splitext(output_path)[1]:
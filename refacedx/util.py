@@ -2,6 +2,9 @@
 #
 # refacedx/util.py
 
+import hashlib
+import logging
+import re
 import sys
 
 from .constants import (ADDRESSES_VOICE_BLOCK, PATCH_NAME_LENGTH, PATCH_NAME_OFFSET,
@@ -9,10 +12,25 @@ from .constants import (ADDRESSES_VOICE_BLOCK, PATCH_NAME_LENGTH, PATCH_NAME_OFF
                         VOICE_COMMON_DATA_LENGTH, VOICE_COMMON_DATA_OFFSET, YAMAHA_MANUFACTURER_ID)
 
 
+log = logging.getLogger(__name__)
+# start of a SysEx message followed by its data bytes, i.e. anything up to the next status byte
+SYSEX_RX = re.compile(b'\xF0[\x00-\x7F]*')
+
+
 def checksum(msg, offset=7, length=None):
     if length is None:
         length = len(msg) - 2
-    return ((sum(msg[offset:offset+length]) ^ 0x7f) & 0x7f) + 1
+    # the value which makes the lower 7 bits of the sum of the data and checksum zero
+    return -sum(msg[offset:offset+length]) & 0x7f
+
+
+def has_valid_checksum(msg):
+    """Return True if the checksum of given Reface DX bulk dump message matches its data.
+
+    The checksum covers the bytes from the model ID up to the end of the data.
+
+    """
+    return len(msg) > 9 and msg[-2] == checksum(msg, offset=7, length=len(msg) - 9)
 
 
 def ellip(s, length=50, suffix='[...]'):
@@ -22,6 +40,20 @@ def ellip(s, length=50, suffix='[...]'):
         return s[:length - len(suffix)] + suffix
 
 
+def get_voice_hash(data):
+    """Return hex digest of the voice parameter payload of Reface DX voice SysEx data.
+
+    Only the data bytes of each bulk dump message are hashed, i.e. the SysEx header, device
+    number, address and checksum bytes are ignored, so the same voice always has the same hash,
+    regardless of which device number it was dumped from.
+
+    """
+    digest = hashlib.sha1()
+    for msg in iter_sysex(data):
+        digest.update(msg[11:-2])
+    return digest.hexdigest()
+
+
 def get_patch_name(data, encoding='ascii'):
     return data[PATCH_NAME_OFFSET:PATCH_NAME_OFFSET + PATCH_NAME_LENGTH].decode(encoding).rstrip()
 
@@ -78,14 +110,139 @@ def is_reface_dx_bulk_dump(msg, address=None, device=None):
 
 
 def is_reface_dx_voice(data):
-    for part, address in zip(split_sysex(data), ADDRESSES_VOICE_BLOCK):
+    try:
+        parts = list(iter_sysex(data, strict=True))
+    except SysExError:
+        return False
+
+    if len(parts) != len(ADDRESSES_VOICE_BLOCK):
+        return False
+
+    for part, address in zip(parts, ADDRESSES_VOICE_BLOCK):
         if not is_reface_dx_bulk_dump(part, address=address):
             return False
     else:
         return True
 
 
-def split_sysex(data):
-    # XXX: quick hack to extract sysex messages from binary data
-    return [b'\xF0' + m.split(b'\xF7', 1)[0] + b'\xF7'
-            for m in data.split(b'\xF0')[1:]]
+class SysExError(ValueError):
+    """Raised by ``iter_sysex`` for malformed SysEx framing.
+
+    The ``offset`` attribute holds the position of the malformed data in the scanned data.
+
+    """
+
+    def __init__(self, message, offset):
+        super().__init__("%s at offset %i." % (message, offset))
+        self.offset = offset
+
+
+def _scan_sysex(data, pos=0, final=True):
+    """Yield (error, start, end) for the SysEx messages and malformed data in given buffer.
+
+    ``error`` is None for a complete message. If ``final`` is False, a message, which is still
+    incomplete at the end of the data, is not reported, since the following data may complete
+    it, so scanning has to be resumed at its start.
+
+    """
+    length = len(data)
+
+    while pos < length:
+        match = SYSEX_RX.search(data, pos)
+
+        if match is None:
+            yield "Data outside of SysEx message", pos, length
+            return
+
+        start, end = match.span()
+
+        if start > pos:
+            yield "Data outside of SysEx message", pos, start
+
+        if end == length:
+            if final:
+                yield "SysEx message without EOX byte", start, end
+
+            return
+        elif data[end] == 0xF7:
+            yield None, start, end + 1
+            pos = end + 1
+        else:
+            yield "SysEx message truncated by status byte 0x%02X" % data[end], start, end
+            pos = end
+
+
+def iter_sysex(source, strict=False, chunk_size=65536, offset=0):
+    """Yield the SysEx messages in given data or binary file as ``memoryview`` instances.
+
+    ``source`` may be any object supporting the buffer protocol, e.g. ``bytes``, ``bytearray``
+    or an ``mmap``, in which case the messages are slices of it and no data is copied. Any other
+    object is treated as a binary file object and read in chunks of ``chunk_size`` bytes, so only
+    the current chunk and a message extending over its end are held in memory.
+
+    Data outside of SysEx messages and messages not ended by an EOX byte (e.g. truncated by the
+    start of the next message) are malformed framing. With ``strict=True``, a ``SysExError`` is
+    raised for them, otherwise they are logged as warnings and skipped. ``offset`` is added to
+    the offsets given in these reports, e.g. if the data is part of a larger buffer.
+
+    """
+    # malformed data not logged yet, adjacent runs of the same kind are logged together
+    skipped = []
+
+    def report(error, start, end):
+        if strict:
+            raise SysExError(error, start)
+
+        if skipped and skipped[0] == error and skipped[2] == start:
+            skipped[2] = end
+        else:
+            flush()
+            skipped.extend((error, start, end))
+
+    def flush():
+        if skipped:
+            error, start, end = skipped
+            log.warning("Skipping %i byte(s) of malformed SysEx data at offset %i: %s.",
+                        end - start, start, error)
+            del skipped[:]
+
+    try:
+        view = memoryview(source).cast('B')
+    except TypeError:
+        pass
+    else:
+        for error, start, end in _scan_sysex(view):
+            if error:
+                report(error, offset + start, offset + end)
+            else:
+                flush()
+                yield view[start:end]
+
+        flush()
+        return
+
+    pending = b''
+
+    while True:
+        chunk = source.read(chunk_size)
+        data = pending + chunk if pending else chunk
+        view = memoryview(data)
+        resume = 0
+
+        for error, start, end in _scan_sysex(data, final=not chunk):
+            if error:
+                report(error, offset + start, offset + end)
+            else:
+                flush()
+                yield view[start:end]
+
+            resume = end
+
+        if not chunk:
+            flush()
+            break
+
+        # keep the start of a message continued in the next chunk
+        pending = data[resume:]
+        # offset of the pending data in the file
+        offset += resume
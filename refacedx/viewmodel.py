@@ -3,6 +3,8 @@
 # refacedx/viewmodel.py
 
 import logging
+import shlex
+from collections import OrderedDict
 
 try:
     from qtpy.QtCore import Qt, QAbstractTableModel, QModelIndex
@@ -12,24 +14,74 @@ except ImportError:
     from PyQt5.QtWidgets import QHeaderView
 
 from dateutil.parser import parse as parse_date
-from sqlalchemy import desc as sa_desc, inspect
+from sqlalchemy import (and_, case, desc as sa_desc, inspect, literal_column, or_, select,
+                        tuple_)
+from sqlalchemy.orm import contains_eager, joinedload, lazyload, load_only, selectinload
+from sqlalchemy_filters import apply_filters
 
+from .codec import decode, encode
 from .constants import PATCH_NAME_LENGTH
-from .model import Author, Device, Manufacturer, Patch, get_or_create
-from .util import set_patch_name
+from .model import (Author, Device, Manufacturer, Patch, Tag, fts_query, get_or_create,
+                    patch_fts, patch_tag)
 
 
 log = logging.getLogger(__name__)
+RELATION_LOADERS = {
+    'joined': joinedload,
+    'selectin': selectinload,
+    'lazy': lazyload,
+}
+FILTER_KEYWORDS = ('after', 'author', 'before', 'name', 'similar', 'tag')
+
+
+def parse_search(text):
+    """Split search text into free text words and a dict of 'keyword:value' filters.
+
+    Values containing spaces can be quoted, e.g. ``author:"Jane Doe"``. The ``tag`` keyword may
+    be given more than once and its value in the returned dict is a list.
+
+    """
+    try:
+        tokens = shlex.split(text)
+    except ValueError:
+        # unbalanced quotes while typing
+        tokens = text.split()
+
+    words = []
+    filters = {}
+
+    for token in tokens:
+        keyword, sep, value = token.partition(':')
+        keyword = keyword.lower()
+
+        if sep and keyword in FILTER_KEYWORDS:
+            if not value:
+                continue
+            elif keyword == 'tag':
+                filters.setdefault('tag', []).append(value)
+            else:
+                filters[keyword] = value
+        else:
+            words.append(token)
+
+    return ' '.join(words), filters
 
 
 class SQLAlchemyTableModel(QAbstractTableModel):
     fields = None
     list_order = None
     sort_relations = {}
+    # Loading strategy ('joined', 'selectin' or 'lazy') for relations listed in fields.
+    # Defaults to 'joined' for scalar relations and 'selectin' for collections.
+    relation_loading = {}
+    readonly = False
 
     def __init__(self, session, sa_model=None, parent=None):
         super().__init__(parent)
         self._session = session
+        self._order = None
+        self._desc = False
+        self._filters = None
 
         if sa_model:
             self.sa_model = sa_model
@@ -49,33 +101,74 @@ class SQLAlchemyTableModel(QAbstractTableModel):
             mode = self.resize_mode.get(field, QHeaderView.ResizeToContents)
             header.setSectionResizeMode(i, mode)
 
-    def _update(self, order=None, desc=False):
-        query = self.get_list_query()
-
+    def _get_order(self, order=None, desc=False):
         if not order and self.list_order:
             if isinstance(self.list_order, str) and self.list_order.endswith('-'):
                 desc = True
-                order = self.list_order[-1:]
+                order = self.list_order[:-1]
             else:
                 order = self.list_order
 
-        if order:
-            field = getattr(self.sa_model, order)
-            relation = self.sort_relations.get(order)
+        return order, desc
 
-            if relation:
-                query.outerjoin(field).order_by(sa_desc(relation) if desc else relation)
-            else:
-                query = query.order_by(sa_desc(field) if desc else field)
+    def _get_sorted_query(self, order=None, desc=False):
+        """Return list query and the expression it is sorted by (or None)."""
+        query = self.get_list_query()
+
+        if not order:
+            return query, None
+
+        relation = self.sort_relations.get(order)
+
+        if relation is not None:
+            # populate the relation from the join needed for sorting anyway
+            attr = getattr(self.sa_model, order)
+            return query.outerjoin(attr).options(contains_eager(attr)), relation
+
+        if order in inspect(self.sa_model).relationships:
+            # can't sort by a relation without a column to sort by
+            return query, None
+
+        return query, getattr(self.sa_model, order)
+
+    def _update(self, order=None, desc=False):
+        self._order, self._desc = order, desc = self._get_order(order, desc)
+        query, sort_expr = self._get_sorted_query(order, desc)
+
+        if sort_expr is not None:
+            query = query.order_by(sa_desc(sort_expr) if desc else sort_expr)
 
         self._rows = query.all()
 
+    def refresh(self):
+        """Reload rows from the database, keeping the current sort order."""
+        self.layoutAboutToBeChanged.emit()
+        self._update(self._order, self._desc)
+        self.layoutChanged.emit()
+
+    @property
+    def filters(self):
+        return self._filters
+
+    def set_filters(self, filter_spec):
+        """Show only rows matching given sqlalchemy-filters filter spec (or all, if None).
+
+        The filters are applied to the list query, so only matching rows are loaded from the
+        database, keeping the current sort order.
+
+        """
+        if filter_spec != self._filters:
+            self._filters = filter_spec or None
+            self.beginResetModel()
+            self._update(self._order, self._desc)
+            self.endResetModel()
+
     def _get_field(self, index):
         name = self.fields[index.column()][0]
-        return name, getattr(self._rows[index.row()], name)
+        return name, getattr(self.get_row(index), name)
 
     def _set_field(self, index, value):
-        item = self._rows[index.row()]
+        item = self.get_row(index)
         name = self.fields[index.column()][0]
         f = getattr(self, 'set_' + name, None)
         if f:
@@ -96,7 +189,19 @@ class SQLAlchemyTableModel(QAbstractTableModel):
         return self._rows[row]
 
     def get_list_query(self):
-        return self._session.query(self.sa_model)
+        query = self._session.query(self.sa_model)
+        relationships = inspect(self.sa_model).relationships
+
+        for name, _ in self.fields:
+            if name in relationships:
+                default = 'selectin' if relationships[name].uselist else 'joined'
+                loader = RELATION_LOADERS[self.relation_loading.get(name, default)]
+                query = query.options(loader(getattr(self.sa_model, name)))
+
+        if self._filters:
+            query = apply_filters(query, self._filters, do_auto_join=False)
+
+        return query
 
     def rowCount(self, parent):
         return len(self._rows)
@@ -105,6 +210,9 @@ class SQLAlchemyTableModel(QAbstractTableModel):
         return len(self.fields)
 
     def flags(self, index):
+        if self.readonly:
+            return Qt.ItemIsEnabled | Qt.ItemIsSelectable
+
         return Qt.ItemIsEditable | Qt.ItemIsEnabled | Qt.ItemIsSelectable
 
     def data(self, index, role):
@@ -139,7 +247,7 @@ class SQLAlchemyTableModel(QAbstractTableModel):
                 if section < len(self.fields):
                     return self.fields[section][1]
             else:
-                return "%i" % self._rows[section].id
+                return "%i" % self.get_row(section).id
 
     def sort(self, col, order):
         """Sort table by given column number col"""
@@ -168,8 +276,176 @@ class SQLAlchemyTableModel(QAbstractTableModel):
 # ~        return True
 
 
-class PatchlistTableModel(SQLAlchemyTableModel):
-    fields = (('displayname', 'Display Name'), 'name', 'author', 'created')
+class PagedSQLAlchemyTableModel(SQLAlchemyTableModel):
+    """Table model, which fetches rows lazily in pages as the view scrolls.
+
+    Pages are selected by keyset pagination on the active sort column (with the primary key as
+    tie-breaker), so fetching a page is an index range scan, regardless of its position in the
+    list. Only the columns listed in ``light_fields`` are loaded.
+
+    Only the ``max_pages`` most recently used pages are kept in memory. For other pages only the
+    sort key of the row preceding the page is remembered, so an evicted page can be fetched again
+    with a single query when it is scrolled back into view.
+
+    """
+    page_size = 200
+    max_pages = 10
+    light_fields = None
+
+    def _update(self, order=None, desc=False):
+        self._order, self._desc = self._get_order(order, desc)
+        self._pages = OrderedDict()
+        # sort key of the row preceding each page; None for the first page
+        self._page_keys = [None]
+        self._row_count = 0
+        self._at_end = False
+        self._row_count = self._fetch_next_page()
+
+    def refresh(self):
+        """Reload rows from the database, keeping the current sort order."""
+        self.beginResetModel()
+        self._update(self._order, self._desc)
+        self.endResetModel()
+
+    def sort(self, col, order):
+        """Sort table by given column number col"""
+        if col < 0:
+            # sort indicator was cleared, keep current order
+            return
+
+        self.beginResetModel()
+        self._update(order=self.fields[col][0], desc=order == Qt.DescendingOrder)
+        self.endResetModel()
+
+    def _get_key_query(self, *entities, after=None):
+        query, sort_expr = self._get_sorted_query(self._order, self._desc)
+        pk = inspect(self.sa_model).primary_key[0]
+
+        if sort_expr is None:
+            sort_expr = pk
+
+        if after is not None:
+            # Outer joined relation columns may be NULL even if the column is not nullable.
+            nullable = (self._order in self.sort_relations or
+                        getattr(sort_expr.expression, 'nullable', True))
+            query = query.filter(self._keyset_clause(sort_expr, pk, *after, nullable=nullable))
+
+        if self._desc:
+            query = query.order_by(sa_desc(sort_expr), sa_desc(pk))
+        else:
+            query = query.order_by(sort_expr, pk)
+
+        if entities:
+            query = query.with_entities(*entities)
+
+        return query.add_columns(sort_expr, pk)
+
+    def _keyset_clause(self, sort_expr, pk, key, id_, nullable=True):
+        # Row value comparisons let SQLite seek to the start of the page in the sort column
+        # index. SQLite sorts NULL values first in ascending order, which needs extra terms.
+        if self._desc:
+            if key is None:
+                return and_(sort_expr.is_(None), pk < id_)
+
+            clause = tuple_(sort_expr, pk) < tuple_(key, id_)
+            return or_(clause, sort_expr.is_(None)) if nullable else clause
+        else:
+            if key is None:
+                return or_(sort_expr.isnot(None), and_(sort_expr.is_(None), pk > id_))
+
+            return tuple_(sort_expr, pk) > tuple_(key, id_)
+
+    def _get_page_key(self, page):
+        """Return sort key of row preceding given page, walking forward from the last known."""
+        while len(self._page_keys) <= page:
+            pk = inspect(self.sa_model).primary_key[0]
+            key = self._get_key_query(pk, after=self._page_keys[-1])
+            key = key.offset(self.page_size - 1).limit(1).first()
+            self._page_keys.append(tuple(key[1:]) if key else None)
+
+        return self._page_keys[page]
+
+    def _load_page(self, page):
+        query = self._get_key_query(after=self._get_page_key(page))
+
+        if self.light_fields:
+            query = query.options(load_only(*self.light_fields))
+
+        rows = query.limit(self.page_size).all()
+        self._pages[page] = [row[0] for row in rows]
+
+        while len(self._pages) > self.max_pages:
+            evicted, _ = self._pages.popitem(last=False)
+            log.debug("Evicted page #%i from %s.", evicted, self.__class__.__name__)
+
+        return rows
+
+    def _fetch_next_page(self):
+        """Load page containing the first row not fetched yet and return number of new rows."""
+        page, offset = divmod(self._row_count, self.page_size)
+        rows = self._load_page(page)
+
+        if len(rows) < self.page_size:
+            self._at_end = True
+        elif len(self._page_keys) == page + 1:
+            self._page_keys.append(tuple(rows[-1][1:]))
+
+        return max(0, len(rows) - offset)
+
+    def get_row(self, row):
+        if isinstance(row, QModelIndex):
+            row = row.row()
+
+        page, offset = divmod(row, self.page_size)
+
+        if page in self._pages:
+            self._pages.move_to_end(page)
+        else:
+            self._load_page(page)
+
+        return self._pages[page][offset]
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self._row_count
+
+    def canFetchMore(self, parent):
+        return not parent.isValid() and not self._at_end
+
+    def fetchMore(self, parent):
+        if parent.isValid() or self._at_end:
+            return
+
+        start = self._row_count
+        count = self._fetch_next_page()
+
+        if count:
+            self.beginInsertRows(QModelIndex(), start, start + count - 1)
+            self._row_count += count
+            self.endInsertRows()
+
+    def removeRows(self, pos, numrows=1, index=QModelIndex()):
+        log.debug("Removing %i row(s) at row %s.", numrows, pos)
+        self.beginRemoveRows(QModelIndex(), pos, pos + numrows - 1)
+
+        for i in range(pos, pos + numrows):
+            self._session.delete(self.get_row(i))
+
+        # Rows after the removed ones shift up, so forget all following pages. The key of the
+        # first affected page is still valid, since it belongs to a row before the removed ones.
+        page = pos // self.page_size
+        del self._page_keys[page + 1:]
+
+        for cached in [p for p in self._pages if p >= page]:
+            del self._pages[cached]
+
+        self._row_count -= numrows
+        self.endRemoveRows()
+        return True
+
+
+class PatchlistTableModel(PagedSQLAlchemyTableModel):
+    fields = (('displayname', 'Display Name'), 'name', 'author', 'tags', 'created')
+    light_fields = ('id', 'name', 'displayname', 'author_id', 'created')
     sa_model = Patch
     datetime_fmt = "%Y-%m-%d %H:%M:%S"
     resize_mode = {'displayname': QHeaderView.Stretch}
@@ -177,6 +453,130 @@ class PatchlistTableModel(SQLAlchemyTableModel):
     sort_relations = {
         'author': Author.name
     }
+    # Callable returning the ids of the patches most similar to the patch with the given id,
+    # used for the 'similar:<id>' search filter, e.g. a partial of similarity.find_similar.
+    similarity_search = None
+
+    def __init__(self, session, sa_model=None, parent=None):
+        self._search = None
+        self._search_filters = {}
+        self._similar = None
+        super().__init__(session, sa_model, parent)
+
+    def search(self, text):
+        """Show only patches matching search text.
+
+        Free text words are matched as prefixes in the full-text index, best matches first.
+        'keyword:value' filters (see ``parse_search``) are compiled with ``get_filter_spec``.
+        'similar:<patch id>' shows the given patch followed by the patches most similar to it.
+        Empty text shows all patches in the default order again. Returns whether the patches
+        are ordered by relevance, i.e. full-text search rank or similarity.
+
+        Raises ``ValueError`` if a filter value is invalid.
+
+        """
+        words, filters = parse_search(text)
+        query = fts_query(words)
+
+        if query != self._search or filters != self._search_filters:
+            similar = self.get_similar(filters['similar']) if 'similar' in filters else None
+            filter_spec = self.get_filter_spec(filters)
+
+            if similar:
+                filter_spec = (filter_spec or []) + [
+                    {'model': 'Patch', 'field': 'id', 'op': 'in', 'value': similar}]
+
+            if similar != self._similar:
+                order = 'similarity' if similar else 'rank' if query else None
+                desc = False
+            elif query != self._search:
+                order = 'rank' if query else 'similarity' if similar else None
+                desc = False
+            else:
+                order, desc = self._order, self._desc
+
+            self._search = query
+            self._search_filters = filters
+            self._similar = similar
+            self._filters = filter_spec
+            self.beginResetModel()
+            self._update(order, desc)
+            self.endResetModel()
+
+        return self._order in ('rank', 'similarity')
+
+    def get_similar(self, patch_id):
+        """Return list of given patch id followed by the ids of the most similar patches."""
+        try:
+            patch_id = int(patch_id)
+        except ValueError:
+            raise ValueError("Invalid patch id '{}'.".format(patch_id))
+
+        if self.similarity_search is None:
+            raise ValueError("Similarity search is not available.")
+
+        try:
+            return [patch_id] + list(self.similarity_search(patch_id))
+        except KeyError:
+            raise ValueError("Patch #{} does not exist or has no valid voice data."
+                             .format(patch_id))
+
+    def get_filter_spec(self, filters):
+        """Compile dict of search filters into a sqlalchemy-filters filter spec list.
+
+        Filters on related tables are expressed as ``IN`` sub-queries on the patch table, so
+        they neither multiply rows nor conflict with the join used for sorting by author.
+
+        """
+        spec = []
+
+        if 'name' in filters:
+            pattern = '%{}%'.format(filters['name'])
+            spec.append({'or': [
+                {'model': 'Patch', 'field': 'displayname', 'op': 'ilike', 'value': pattern},
+                {'model': 'Patch', 'field': 'name', 'op': 'ilike', 'value': pattern}
+            ]})
+
+        if 'author' in filters:
+            pattern = '{}%'.format(filters['author'])
+            authors = select([Author.id]).where(or_(Author.name.ilike(pattern),
+                                                    Author.displayname.ilike(pattern)))
+            spec.append({'model': 'Patch', 'field': 'author_id', 'op': 'in', 'value': authors})
+
+        for tagname in filters.get('tag', []):
+            tags = select([Tag.id]).where(Tag.name.ilike(tagname))
+            tagged = select([patch_tag.c.patch_id]).where(patch_tag.c.tag_id.in_(tags))
+            spec.append({'model': 'Patch', 'field': 'id', 'op': 'in', 'value': tagged})
+
+        for keyword, op in (('after', '>='), ('before', '<')):
+            if keyword in filters:
+                try:
+                    dt = parse_date(filters[keyword])
+                except (ValueError, OverflowError) as exc:
+                    raise ValueError("Invalid date '{}': {}".format(filters[keyword], exc))
+
+                spec.append({'model': 'Patch', 'field': 'created', 'op': op, 'value': dt})
+
+        return spec or None
+
+    def get_list_query(self):
+        query = super().get_list_query()
+
+        if self._search:
+            query = (query.join(patch_fts, patch_fts.c.rowid == Patch.id)
+                     .filter(literal_column(patch_fts.name).op('MATCH')(self._search)))
+
+        return query
+
+    def _get_sorted_query(self, order=None, desc=False):
+        if order == 'rank':
+            return self.get_list_query(), patch_fts.c.rank
+
+        if order == 'similarity':
+            return self.get_list_query(), case(
+                {id_: pos for pos, id_ in enumerate(self._similar)}, value=Patch.id)
+
+        return super()._get_sorted_query(order, desc)
 
     def display_created(self, index, value):
         return value.strftime(self.datetime_fmt)
@@ -184,8 +584,11 @@ class PatchlistTableModel(SQLAlchemyTableModel):
     def display_author(self, index, value):
         return str(value) if value else ''
 
+    def display_tags(self, index, value):
+        return ', '.join(sorted(tag.name for tag in value))
+
     def tooltip_displayname(self, index, value):
-        return self._rows[index.row()].name
+        return self.get_row(index).name
 
     def set_author(self, index, item, value):
         # Did value change?
@@ -201,6 +604,12 @@ class PatchlistTableModel(SQLAlchemyTableModel):
 
             item.author = author
 
+    def set_tags(self, index, item, value):
+        tags = (tag.strip() for tag in value.split(','))
+
+        with self._session.begin():
+            item.update_tags(self._session, (tag for tag in tags if tag))
+
     def set_created(self, index, item, value):
         try:
             dt = parse_date(value)
@@ -212,16 +621,22 @@ class PatchlistTableModel(SQLAlchemyTableModel):
                     item.created = dt
 
     def set_name(self, index, item, value):
+        try:
+            voice = decode(item.data)
+        except ValueError as exc:
+            log.warning("Cannot rename patch #%i: %s", item.id, exc)
+            return
+
         with self._session.begin():
             item.name = value[:PATCH_NAME_LENGTH]
-            item.data = set_patch_name(item.data, value)
+            item.data = encode(voice._replace(name=value), template=item.data)
 
 
 class NamedItemsListModel(SQLAlchemyTableModel):
     list_order = 'displayname'
 
     def display_displayname(self, index, value):
-        return value if value is not None else self._rows[index.row()].name
+        return value if value is not None else self.get_row(index).name
 
 
 class AuthorListModel(NamedItemsListModel):
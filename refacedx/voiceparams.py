@@ -43,7 +43,7 @@ params_common = (
     (0x11, 1, int, "lfo_wave", (0, 6), lfo_wave, "LFO Waveform"),
     (0x12, 1, int, "lfo_speed", (0, 127), None, "LFO Speed"),
     (0x13, 1, int, "lfo_delay", (0, 127), None, "LFO Delay"),
-    (0x14, 1, int, "lfp_pmd", (0, 127), None, "LFO Pitch Modulation Depth"),
+    (0x14, 1, int, "lfo_pmd", (0, 127), None, "LFO Pitch Modulation Depth"),
     (0x15, 1, int, "pitch_eg_rate_1", (0, 127), None, "Pitch EG Rate 1"),
     (0x16, 1, int, "pitch_eg_rate_2", (0, 127), None, "Pitch EG Rate 2"),
     (0x17, 1, int, "pitch_eg_rate_3", (0, 127), None, "Pitch EG Rate 3"),
@@ -87,14 +87,33 @@ params_op = (
      "LFO Operator Pitch Modulation On/Off"),
     (0x10, 1, bool, "op_peg_pm_enable", (0, 1), None,
      "Pitch EG Operator Pitch Modulation On/Off"),
-    (0x11, 1, int, "op_leveL_velocity_sens", (0, 127), None,
+    (0x11, 1, int, "op_level_velocity_sens", (0, 127), None,
      "Operator Level Velocity Sensitivity"),
-    (0x12, 1, int, "op_leveL", (0, 127), None, "Operator Output Level"),
+    (0x12, 1, int, "op_level", (0, 127), None, "Operator Output Level"),
     (0x13, 1, int, "op_feedback_level", (0, 127), None, "Operator Feedback Level"),
     (0x14, 1, int, "op_feedback_type", (0, 1), ("sawtooth", "square"), "Operator Feedback Type"),
-    (0x15, 1, int, "op_freq_mode", (0, 1), ("ration", "fixed"), "Operator Frequency Mode"),
+    (0x15, 1, int, "op_freq_mode", (0, 1), ("ratio", "fixed"), "Operator Frequency Mode"),
     (0x16, 1, int, "op_freq_ratio_coarse", (0, 0x1f), None, "Operator Frequency Ratio Coarse"),
     (0x17, 1, int, "op_freq_ratio_fine", (0, 63), None, "Operator Frequency Ratio Fine"),
     (0x18, 1, int, "op_freq_detunes", (0, 127), (-64, 63), "Operator Frequency Detune"),
     (0x19, 3, None, "reserved", None, None, None)
 )
+
+
+def iter_voice_params():
+    """Yield (name, part, offset, type, description) for all voice parameters with a value.
+
+    ``part`` is the index of the bulk dump message of a voice the parameter is contained in and
+    ``offset`` the offset into the message data. Operator parameter names are prefixed with the
+    operator number, e.g. ``op1_level``. The voice name and reserved bytes are skipped.
+
+    """
+    for offset, _, type_, name, _, _, description in params_common:
+        if type_ in (int, bool):
+            yield name, 1, offset, type_, description
+
+    for op in range(1, 5):
+        for offset, _, type_, name, _, _, description in params_op:
+            if type_ in (int, bool):
+                yield ('op%i%s' % (op, name[2:]), op + 1, offset, type_,
+                       description.replace('Operator', 'Operator %i' % op, 1))
@@ -28,6 +28,7 @@ setup(
     author_email="info@chrisarndt.de",
     url="https://github.com/SpotlightKid/reface-dx-lib",
     packages=["refacedx", "refacedx.tools"],
+    python_requires='>=3.7',
     install_requires=[
         'qtpy',
         'python-rtmidi>=1.1.1',
@@ -42,12 +43,15 @@ setup(
             'lockfile',
             'requests',
         ],
+        'analysis': ['numpy'],
         'pyqt': ['PyQt5'],
         'pyside': ['PySide2'],
     },
     entry_points={
         'console_scripts': [
             "reface-dx-lib = refacedx.app:main",
+            "reface-find-duplicates = refacedx.tools.find_duplicates:main [analysis]",
+            "reface-import-patches = refacedx.tools.import_patches:main",
             "reface-request-patch = refacedx.tools.request_patch:main",
             "reface-get-soundmondo-voice = refacedx.tools.get_soundmondo_voice:main [soundmondo]"
         ]
@@ -62,8 +66,6 @@ setup(
         'Operating System :: POSIX :: Linux',
         'Programming Language :: Python',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.5',
-        'Programming Language :: Python :: 3.6',
         'Programming Language :: Python :: 3.7',
         'Programming Language :: Python :: 3.8',
         'Programming Language :: Python :: 3 :: Only',